@@ -0,0 +1,56 @@
+"""
+Benchmark the message insert throughput of the per-row insert path
+against the batched DB.insert_messages() path used by Sync.
+
+    python benchmarks/bench_insert.py [-n 100000] [--batch 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synthetic import make_messages  # noqa: E402
+from tgarchive.db import DB  # noqa: E402
+
+
+def per_row(db, messages, batch):
+    """The previous Sync insert path: one execute() per row, commit every 300 rows."""
+    for n, m in enumerate(messages, 1):
+        db.insert_user(m.user)
+        if m.media:
+            db.insert_media(m.media)
+        db.insert_message(m)
+        if n % 300 == 0:
+            db.commit()
+    db.commit()
+
+
+def batched(db, messages, batch):
+    db.set_ingest_pragmas()
+    for i in range(0, len(messages), batch):
+        db.insert_messages(messages[i:i + batch])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", type=int, default=100000, help="number of messages")
+    p.add_argument("--batch", type=int, default=2000, help="batch size (fetch_batch_size)")
+    args = p.parse_args()
+
+    messages = list(make_messages(args.n))
+    with tempfile.TemporaryDirectory() as d:
+        for name, fn in (("per-row", per_row), ("batched", batched)):
+            db = DB(os.path.join(d, "{}.sqlite".format(name)))
+            start = time.perf_counter()
+            fn(db, messages, args.batch)
+            took = time.perf_counter() - start
+            db.conn.close()
+            print("{:10} {:8d} messages in {:6.2f}s = {:10.0f} messages/s".format(
+                name, args.n, took, args.n / took))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark the peak memory (max RSS) of rendering a single page of
+per_page messages with the streaming page writer, against fully loading
+the page's messages and rendering the page to a string in memory.
+
+    python benchmarks/bench_memory.py [--sizes 500 2000 8000] [--content 2000]
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synthetic import make_messages, make_db  # noqa: E402
+from tgarchive import _CONFIG  # noqa: E402
+from tgarchive.build import Build, _Page  # noqa: E402
+from tgarchive.db import DB  # noqa: E402
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "tgarchive", "example")
+
+
+def render(dbfile, outdir, per_page, mode):
+    """Render the first page of the month and return the peak RSS in MB."""
+    config = {**_CONFIG, "group": "bench", "per_page": per_page, "publish_dir": outdir}
+    db = DB(dbfile)
+    b = Build(config, db)
+    b.load_template(os.path.join(EXAMPLE_DIR, "template.html"))
+
+    month = list(db.get_timeline())[0]
+    b.timeline[month.date.year] = [month]
+    dayline = OrderedDict((d.slug, d) for d in db.get_dayline(
+        month.date.year, month.date.month, per_page))
+
+    total_pages = 1
+    if mode == "streaming":
+        p = _Page(b, month, dayline, 1, total_pages, 0)
+        b._render_page(p, month, dayline, "page.html", 1, total_pages, p.reply_ids)
+    else:
+        # The previous path: load the whole page and render it to a string.
+        messages = list(db.get_messages(month.date.year, month.date.month, 0, per_page))
+        html = b.template.render(messages=messages, page_ids=b.page_ids, fragments={},
+                                 **b._page_vars(month, dayline, 1, total_pages))
+        with open(os.path.join(outdir, "page.html"), "w", encoding="utf8") as f:
+            f.write(html)
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 8000],
+                   help="per_page values to benchmark")
+    p.add_argument("--content", type=int, default=2000, help="characters per message")
+    p.add_argument("--child", nargs=4, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    # Each measurement runs in its own process to get its own peak RSS.
+    if args.child:
+        dbfile, outdir, per_page, mode = args.child
+        print(render(dbfile, outdir, int(per_page), mode))
+        return
+
+    d = tempfile.mkdtemp()
+    try:
+        dbfile = os.path.join(d, "data.sqlite")
+        # Long messages, all in the same month.
+        make_db(dbfile, make_messages(max(args.sizes), media=0, polls=0, replies=0, days=1,
+                                      content=args.content), 1000).conn.close()
+
+        print("{:>8} {:>14} {:>14}".format("per_page", "streaming MB", "in-memory MB"))
+        for size in args.sizes:
+            res = []
+            for mode in ("streaming", "in-memory"):
+                out = subprocess.check_output([sys.executable, __file__, "--child",
+                                               dbfile, d, str(size), mode])
+                res.append(float(out))
+            print("{:8d} {:14.1f} {:14.1f}".format(size, *res))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main()
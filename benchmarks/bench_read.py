@@ -0,0 +1,102 @@
+"""
+Benchmark the read throughput (rows/s) of DB.get_messages() against the
+previous read path, which selected the user columns on every row, made a
+new User() per message, parsed timestamps with sqlite3's converter, and
+decoded polls on every row.
+
+    python benchmarks/bench_read.py [-n 100000] [--per-page 1000]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synthetic import make_messages, make_db  # noqa: E402
+from tgarchive.db import DB, User, Message, Media, _month  # noqa: E402
+
+
+def get_messages_before(db, year, month, last_id=0, limit=500):
+    """The previous DB.get_messages() and DB._make_message()."""
+    cur = db.conn.cursor()
+    cur.execute("""
+        SELECT messages.id, messages.type, messages.date, messages.edit_date,
+        messages.content, messages.reply_to, messages.user_id,
+        users.username, users.first_name, users.last_name, users.tags, users.avatar,
+        media.id, media.type, media.url, media.title, media.description, media.thumb
+        FROM messages
+        LEFT JOIN users ON (users.id = messages.user_id)
+        LEFT JOIN media ON (media.id = messages.media_id)
+        WHERE messages.month = ?
+        AND messages.id > ? ORDER by messages.id LIMIT ?
+        """, (_month(year, month), last_id, limit))
+
+    for r in cur:
+        id, typ, date, edit_date, content, reply_to, \
+            user_id, username, first_name, last_name, tags, avatar, \
+            media_id, media_type, media_url, media_title, media_description, media_thumb = r
+
+        md = None
+        if media_id:
+            desc = media_description
+            if media_type == "poll":
+                desc = json.loads(media_description)
+
+            md = Media(id=media_id, type=media_type, url=media_url, title=media_title,
+                       description=desc, thumb=media_thumb)
+
+        yield Message(id=id, type=typ, date=date, edit_date=edit_date, content=content,
+                      reply_to=reply_to,
+                      user=User(id=user_id, username=username, first_name=first_name,
+                                last_name=last_name, tags=tags, avatar=avatar),
+                      media=md)
+
+
+def get_messages_after(db, year, month, last_id=0, limit=500):
+    return db.get_messages(year, month, last_id, limit)
+
+
+def read_all(db, fn, per_page):
+    """Read every message month by month, page by page, like Build."""
+    n = 0
+    for month in list(db.get_timeline()):
+        last_id = 0
+        while True:
+            count = 0
+            for m in fn(db, month.date.year, month.date.month, last_id, per_page):
+                last_id = m.id
+                count += 1
+            n += count
+            if count < per_page:
+                break
+    return n
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", type=int, default=100000, help="number of messages")
+    p.add_argument("--per-page", type=int, default=1000, help="messages per page (per_page)")
+    args = p.parse_args()
+
+    # 5% of the messages are polls.
+    messages = make_messages(args.n, polls=0.05)
+
+    with tempfile.TemporaryDirectory() as d:
+        make_db(os.path.join(d, "data.sqlite"), messages).conn.close()
+
+        for name, fn in (("before", get_messages_before), ("after", get_messages_after)):
+            # A fresh connection for every run so that no caches carry over.
+            db = DB(os.path.join(d, "data.sqlite"))
+            start = time.perf_counter()
+            n = read_all(db, fn, args.per_page)
+            took = time.perf_counter() - start
+            db.conn.close()
+            print("{:8} {:8d} rows in {:6.2f}s = {:10.0f} rows/s".format(
+                name, n, took, n / took))
+
+
+if __name__ == "__main__":
+    main()
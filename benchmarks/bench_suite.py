@@ -0,0 +1,218 @@
+"""
+Benchmark suite that times DB queries, full and incremental builds,
+per-page rendering, and the Sync ingest path against a fake Telegram
+client on a synthetic archive. Results are written as JSON that can be
+compared with the results of another run.
+
+    python benchmarks/bench_suite.py [-n 20000] [--out results.json] [--compare old.json]
+
+Feeds are left out of builds unless --feeds is given as they need the
+tg-archive package to be installed.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synthetic import make_messages, make_db, to_telegram, FakeClient  # noqa: E402
+from tgarchive import _CONFIG  # noqa: E402
+from tgarchive.build import Build, _Page  # noqa: E402
+from tgarchive.db import DB  # noqa: E402
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "tgarchive", "example")
+
+
+def timed(results, name, fn, count=None):
+    """Run fn() and record its duration and, if count is given, its rate."""
+    start = time.perf_counter()
+    out = fn()
+    took = time.perf_counter() - start
+
+    res = {"seconds": round(took, 4)}
+    if count is not None:
+        n = count(out) if callable(count) else count
+        res["count"] = n
+        res["per_second"] = round(n / took, 1) if took > 0 else None
+    results[name] = res
+
+    print("{:32} {:9.3f}s {}".format(name, took, "{:>12.1f}/s".format(res["per_second"])
+                                     if res.get("per_second") else ""))
+    return out
+
+
+def make_config(args):
+    # Paths are relative to the site directory, the working directory.
+    return {**_CONFIG,
+            "group": "bench",
+            "per_page": args.per_page,
+            "publish_dir": "site",
+            "media_dir": "media",
+            "cache_dir": "cache",
+            "static_dir": "static",
+            "publish_rss_feed": args.feeds,
+            "download_media": False,
+            "download_avatars": False,
+            "fetch_wait": 0,
+            "fetch_wait_min": 0}
+
+
+def bench_db(results, db, args):
+    timeline = timed(results, "db.get_timeline", lambda: list(db.get_timeline()), len)
+
+    def daylines():
+        return sum(len(list(db.get_dayline(m.date.year, m.date.month, args.per_page)))
+                   for m in timeline)
+    timed(results, "db.get_dayline (all months)", daylines, lambda n: n)
+
+    def messages():
+        n = 0
+        for m in timeline:
+            last_id = 0
+            while True:
+                page = list(db.get_messages(m.date.year, m.date.month, last_id, args.per_page))
+                n += len(page)
+                if len(page) < args.per_page:
+                    break
+                last_id = page[-1].id
+        return n
+    timed(results, "db.get_messages (all pages)", messages, lambda n: n)
+
+    timed(results, "db.get_last_messages", lambda: list(db.get_last_messages(100)), len)
+    timed(results, "db.get_last_messages per month",
+          lambda: list(db.get_last_messages(100, per="month")), len)
+    timed(results, "db.get_message_pages (replies)",
+          lambda: list(db.get_message_pages(args.per_page)), len)
+    timed(results, "db.search", lambda: list(db.search("telegram archive", 1000)), len)
+
+
+def bench_build(results, db, args):
+    config = make_config(args)
+
+    def build(incremental=False):
+        b = Build(config, db)
+        b.load_template(os.path.join(EXAMPLE_DIR, "template.html"))
+        b.build(incremental=incremental)
+
+    timed(results, "build (full)", build)
+    timed(results, "build (incremental, unchanged)", lambda: build(True))
+
+    # Render the first pages of the first month one by one.
+    b = Build(config, db)
+    b.load_template(os.path.join(EXAMPLE_DIR, "template.html"))
+    b.timeline = OrderedDict()
+    for m in db.get_timeline():
+        b.timeline.setdefault(m.date.year, []).append(m)
+    b.page_ids = {p.id: b.make_filename(p.month, p.page)
+                  for p in db.get_message_pages(args.per_page)}
+
+    month = next(iter(b.timeline.values()))[0]
+    dayline = OrderedDict((x.slug, x) for x in db.get_dayline(
+        month.date.year, month.date.month, args.per_page))
+    total = -(-month.count // args.per_page)
+
+    def render():
+        last_id = 0
+        for page in range(1, total + 1):
+            p = _Page(b, month, dayline, page, total, last_id)
+            fragments = b._render_fragments(["timeline", "dayline", "pagination"],
+                                            month, dayline, page, total)
+            b._render_page(p, month, dayline, p.fname, page, total, p.reply_ids, fragments)
+            last_id = p.last_id
+        return total
+    timed(results, "build page render", render, lambda n: n)
+
+
+def bench_sync(results, messages, args):
+    from tgarchive.sync import Sync
+
+    config = {**make_config(args), "fetch_batch_size": args.batch}
+    client = FakeClient([to_telegram(m) for m in messages], latency=args.latency)
+    db = DB("sync.sqlite")
+
+    timed(results, "sync (fake client)",
+          lambda: Sync(config, None, db, client=client).sync(), len(messages))
+
+
+def compare(results, path):
+    with open(path, "r") as f:
+        old = json.load(f)["results"]
+
+    print("\n{:32} {:>10} {:>10} {:>8}".format("compared to " + os.path.basename(path),
+                                              "old", "new", "change"))
+    for name, r in results.items():
+        if name not in old or not old[name]["seconds"]:
+            continue
+        print("{:32} {:9.3f}s {:9.3f}s {:+7.1f}%".format(
+            name, old[name]["seconds"], r["seconds"],
+            (r["seconds"] - old[name]["seconds"]) / old[name]["seconds"] * 100))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", type=int, default=20000, help="number of messages")
+    p.add_argument("--users", type=int, default=200, help="number of users")
+    p.add_argument("--media", type=float, default=0.05, help="fraction of messages with webpages")
+    p.add_argument("--polls", type=float, default=0.01, help="fraction of messages with polls")
+    p.add_argument("--replies", type=float, default=0.2, help="fraction of messages that are replies")
+    p.add_argument("--days", type=int, default=365, help="number of days the messages span")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("--per-page", type=int, default=500, help="messages per page (per_page)")
+    p.add_argument("--batch", type=int, default=2000, help="sync batch size (fetch_batch_size)")
+    p.add_argument("--latency", type=float, default=0, help="fake Telegram request latency in seconds")
+    p.add_argument("--feeds", action="store_true", help="include RSS feeds in builds")
+    p.add_argument("--skip", nargs="+", default=[], choices=["db", "build", "sync"],
+                   help="benchmarks to skip")
+    p.add_argument("--out", type=str, help="write the results to this JSON file")
+    p.add_argument("--compare", type=str, help="compare the results with this JSON file")
+    args = p.parse_args()
+
+    for f in ("out", "compare"):
+        if getattr(args, f):
+            setattr(args, f, os.path.abspath(getattr(args, f)))
+
+    results = OrderedDict()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as d:
+        # Run in a site directory like the one tg-archive --new creates.
+        shutil.copytree(os.path.join(EXAMPLE_DIR, "static"), os.path.join(d, "static"))
+        os.chdir(d)
+
+        try:
+            messages = list(make_messages(args.n, args.users, args.media, args.polls,
+                                          args.replies, args.days, args.seed))
+            db = timed(results, "db.insert_messages", lambda: make_db(
+                "data.sqlite", messages, args.batch), len(messages))
+
+            if "db" not in args.skip:
+                bench_db(results, db, args)
+            if "build" not in args.skip:
+                bench_build(results, db, args)
+            if "sync" not in args.skip:
+                bench_sync(results, messages, args)
+        finally:
+            os.chdir(cwd)
+
+    out = {"meta": {"date": datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "sqlite": sqlite3.sqlite_version,
+                    "args": vars(args)},
+           "results": results}
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(out, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Deterministic synthetic archives for benchmarks, and a fake Telegram
+client that serves them to Sync.
+
+The same arguments and seed always generate the same archive.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tgarchive.db import DB, User, Message, Media  # noqa: E402
+
+WORDS = ("the a to and of in is it you that was for on are with as be this have "
+         "from or one had by word but not what all were we when your can said there "
+         "telegram group archive message link photo poll release update thanks "
+         "https://example.com/page").split()
+
+
+def make_messages(n=10000, users=200, media=0.05, polls=0.01, replies=0.2,
+                  days=365, seed=1, content=0):
+    """
+    Generate n messages from the given number of users, spread over the
+    given number of days starting on 2020-01-01. media, polls, and replies
+    are the fractions of messages with a webpage, with a poll, and that
+    reply to an earlier message. If content is set, the text of every
+    message is repeated to that many characters.
+    """
+    rnd = random.Random(seed)
+    people = [User(id=i, username="user{}".format(i), first_name="First{}".format(i),
+                   last_name="Last{}".format(i), tags=["bot"] if i % 50 == 0 else [],
+                   avatar=None)
+              for i in range(1, users + 1)]
+
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    step = days * 86400 / max(n, 1)
+    for i in range(1, n + 1):
+        date = start + timedelta(seconds=int(step * (i - 1) + rnd.random() * step))
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 60)))
+        if content:
+            text = ((text + "\n") * (content // (len(text) + 1) + 1))[:content]
+
+        md = None
+        r = rnd.random()
+        if r < polls:
+            options = [{"label": "option {}".format(o), "count": rnd.randint(0, 50),
+                        "correct": False} for o in range(rnd.randint(2, 5))]
+            total = sum(o["count"] for o in options)
+            for o in options:
+                o["percent"] = o["count"] / total * 100 if total > 0 else 0
+            md = Media(id=i, type="poll", url=None, title="Question {}?".format(i),
+                       description=json.dumps(options), thumb=None)
+        elif r < polls + media:
+            md = Media(id=i, type="webpage", url="https://example.com/{}".format(i),
+                       title="Page {}".format(i), description="Description of page {}".format(i),
+                       thumb=None)
+
+        yield Message(id=i, type="message", date=date, edit_date=None, content=text,
+                      reply_to=rnd.randint(1, i - 1) if i > 1 and rnd.random() < replies else None,
+                      user=rnd.choice(people), media=md)
+
+
+def make_db(path, messages, batch=2000):
+    """Write messages to a new DB at path."""
+    db = DB(path)
+    b = []
+    for m in messages:
+        b.append(m)
+        if len(b) == batch:
+            db.insert_messages(b)
+            b = []
+    db.insert_messages(b)
+    return db
+
+
+def to_telegram(m: Message):
+    """Make a Telethon-like message out of a Message for FakeClient."""
+    import telethon.tl.types as T
+
+    sender = T.User(id=m.user.id, username=m.user.username, first_name=m.user.first_name,
+                    last_name=m.user.last_name, bot="bot" in m.user.tags,
+                    scam=False, fake=False, photo=None)
+
+    media = None
+    if m.media and m.media.type == "webpage":
+        media = T.MessageMediaWebPage(webpage=T.WebPage(
+            id=m.media.id, url=m.media.url, display_url=m.media.url, hash=0,
+            title=m.media.title, description=m.media.description))
+    elif m.media and m.media.type == "poll":
+        options = json.loads(m.media.description)
+        media = T.MessageMediaPoll(
+            poll=SimpleNamespace(question=m.media.title,
+                                 answers=[SimpleNamespace(text=o["label"]) for o in options]),
+            results=SimpleNamespace(total_voters=sum(o["count"] for o in options),
+                                    results=[SimpleNamespace(voters=o["count"], correct=False)
+                                             for o in options]))
+
+    return SimpleNamespace(id=m.id, date=m.date, edit_date=m.edit_date, sender=sender,
+                           media=media, raw_text=m.content, action=None,
+                           reply_to=SimpleNamespace(reply_to_msg_id=m.reply_to) if m.reply_to else None,
+                           reply_to_msg_id=m.reply_to)
+
+
+class FakeClient:
+    """
+    A stand-in for Telethon's TelegramClient that serves messages from
+    memory, with an optional latency per request, for benchmarking Sync.
+    """
+
+    def __init__(self, messages, latency=0):
+        self.messages = sorted(messages, key=lambda m: m.id)
+        self.by_id = {m.id: m for m in self.messages}
+        self.latency = latency
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+
+    async def get_dialogs(self):
+        return []
+
+    async def get_entity(self, group):
+        return SimpleNamespace(id=1)
+
+    async def get_messages(self, group, offset_id=0, limit=100, ids=None, reverse=False):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if ids is not None:
+            return [self.by_id.get(i) for i in ids]
+        if not reverse:
+            return self.messages[::-1][:limit]
+
+        # Messages are in ID order.
+        lo, hi = 0, len(self.messages)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.messages[mid].id <= offset_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.messages[lo:lo + limit]
@@ -6,6 +6,7 @@ import sys
 import yaml
 
 from .db import DB
+from .stats import Stats
 
 __version__ = "0.3.6"
 
@@ -19,15 +20,37 @@ _CONFIG = {
     "download_avatars": True,
     "avatar_size": [64, 64],
     "download_media": False,
+    "download_workers": 4,
+    "download_retries": 3,
+    "process_images": True,
+    "image_sizes": [320, 640, 1280],
+    "image_formats": ["webp", "jpeg"],
+    "image_workers": 4,
     "media_dir": "media",
     "fetch_batch_size": 2000,
     "fetch_wait": 5,
+    "fetch_wait_min": 1,
+    "fetch_wait_max": 300,
     "fetch_limit": 0,
+    "backfill_workers": 4,
+    "backfill_range_size": 50000,
+    "reconcile_window": 5000,
 
     "publish_rss_feed": True,
     "rss_feed_entries": 100,
+    "rss_feed_months": False,
+    "rss_feed_users": False,
+
+    "publish_search": True,
+    "search_shard_size": 50000,
+    "publish_compression": ["gzip"],
+
+    "lazy_pages": False,
+    "lazy_chunk_size": 100,
 
     "publish_dir": "site",
+    "cache_dir": ".cache",
+    "media_publish_mode": "link",
     "site_url": "https://mysite.com",
     "static_dir": "static",
     "telegram_url": "https://t.me/{id}",
@@ -47,6 +70,26 @@ def get_config(path):
     return config
 
 
+def get_group_configs(config):
+    """
+    Get the config of every group of a multi-group config (groups). A group's
+    config is the config with the group's own settings on top. The group's DB
+    (data), publish_dir, and media_dir default to a directory named after the
+    group.
+    """
+    base = {k: v for k, v in config.items() if k != "groups"}
+
+    out = []
+    for g in config["groups"]:
+        name = str(g["group"])
+        out.append({**base,
+                    "data": os.path.join(name, "data.sqlite"),
+                    "publish_dir": os.path.join(name, "site"),
+                    "media_dir": os.path.join(name, "media"),
+                    **g})
+    return out
+
+
 def main():
     """Run the CLI."""
     p = argparse.ArgumentParser(
@@ -60,6 +103,10 @@ def main():
     p.add_argument("-se", "--session", action="store", type=str, default="session.session",
                    dest="session", help="path to the session file")
     p.add_argument("-v", "--version", action="store_true", dest="version", help="display version")
+    p.add_argument("--profile", action="store", type=str, nargs="?", const="profile.json",
+                   dest="profile", help="print the time spent in each phase of a sync or build, counters, and DB query times, and write them to this JSON file")
+    p.add_argument("--profile-phase", action="store", type=str,
+                   dest="profile_phase", help="run this phase (eg: 'build: pages') under cProfile with --profile and write its output next to the JSON file as .prof")
 
     n = p.add_argument_group("new")
     n.add_argument("-n", "--new", action="store_true",
@@ -72,6 +119,12 @@ def main():
                    dest="sync", help="sync data from telegram group to the local DB")
     s.add_argument("-id", "--id", action="store", type=int, nargs="+",
                    dest="id", help="sync (or update) data for specific message ids")
+    s.add_argument("--backfill", action="store_true",
+                   dest="backfill", help="fetch the group's whole history in ranges of message ids with concurrent workers. Interrupted backfills are resumed")
+    s.add_argument("--reconcile", action="store_true",
+                   dest="reconcile", help="check the latest messages (reconcile_window) for edits and deletions")
+    s.add_argument("--images", action="store_true",
+                   dest="images", help="only make the thumbnails and sizes of downloaded media images that haven't been processed yet (process_images)")
 
     b = p.add_argument_group("build")
     b.add_argument("-b", "--build", action="store_true",
@@ -80,9 +133,17 @@ def main():
                    dest="template", help="path to the template file")
     b.add_argument("-o", "--output", action="store", type=str, default="site",
                    dest="output", help="path to the output directory")
+    b.add_argument("-w", "--workers", action="store", type=int, default=1,
+                   dest="workers", help="number of processes to render pages in parallel")
+    b.add_argument("--incremental", action="store_true",
+                   dest="incremental", help="only re-render pages whose data has changed since the last build")
 
     args = p.parse_args(args=None if sys.argv[1:] else ['--help'])
 
+    stats = None
+    if args.profile:
+        stats = Stats(args.profile_phase)
+
     if args.version:
         print("v{}".format(__version__))
         quit()
@@ -105,31 +166,79 @@ def main():
 
         logging.info("created directory '{}'".format(args.path))
 
+    # Make thumbnails and sizes of the downloaded media images.
+    elif args.images:
+        from .images import Images
+
+        cfg = get_config(args.config)
+        groups = get_group_configs(cfg) if cfg.get("groups") else [cfg]
+        try:
+            for c in groups:
+                db = DB(c.get("data", args.data))
+                if stats:
+                    stats.trace(db)
+                Images(c, db, stats=stats).run()
+        except KeyboardInterrupt as e:
+            logging.info("image processing cancelled manually")
+            quit()
+        finally:
+            if stats:
+                stats.save(args.profile)
+
     # Sync from Telegram.
     elif args.sync:
         # Import because the Telegram client import is quite heavy.
-        from .sync import Sync
+        from .sync import Sync, sync_groups
 
         cfg = get_config(args.config)
-        logging.info("starting Telegram sync (batch_size={}, limit={}, wait={})".format(
-            cfg["fetch_batch_size"], cfg["fetch_limit"], cfg["fetch_wait"]
+        logging.info("starting Telegram sync (batch_size={}, limit={}, wait={}, min_wait={}, max_wait={})".format(
+            cfg["fetch_batch_size"], cfg["fetch_limit"], cfg["fetch_wait"],
+            cfg["fetch_wait_min"], cfg["fetch_wait_max"]
         ))
 
         try:
-            Sync(cfg, args.session, DB(args.data)).sync(args.id)
+            if cfg.get("groups"):
+                if args.id:
+                    logging.error("--id can't be used with multiple groups")
+                    quit(1)
+
+                groups = get_group_configs(cfg)
+                logging.info("syncing {} groups".format(len(groups)))
+                sync_groups(groups, args.session, None, args.backfill, args.reconcile, stats)
+            else:
+                db = DB(args.data)
+                if stats:
+                    stats.trace(db)
+                Sync(cfg, args.session, db, stats=stats).sync(args.id, args.backfill, args.reconcile)
         except KeyboardInterrupt as e:
             logging.info("sync cancelled manually")
             quit()
         except:
             raise
+        finally:
+            if stats:
+                stats.save(args.profile)
 
     # Build static site.
     elif args.build:
         from .build import Build
 
-        logging.info("building site")
-        b = Build(get_config(args.config), DB(args.data))
-        b.load_template(args.template)
-        b.build()
+        cfg = get_config(args.config)
+        groups = get_group_configs(cfg) if cfg.get("groups") else [cfg]
+
+        # Sites of all the groups are built in one run with the template
+        # compiled once.
+        for c in groups:
+            logging.info("building site for {}".format(c["group"]))
+            db = DB(c.get("data", args.data))
+            if stats:
+                stats.trace(db)
+
+            b = Build(c, db, stats=stats)
+            b.load_template(args.template)
+            b.build(incremental=args.incremental, workers=args.workers)
+
+            logging.info("published to directory '{}'".format(c["publish_dir"]))
 
-        logging.info("published to directory '{}'".format(args.output))
+        if stats:
+            stats.save(args.profile)
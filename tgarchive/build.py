@@ -1,87 +1,267 @@
 from collections import OrderedDict, deque
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import gzip
+import hashlib
+from itertools import groupby, islice
+import json
 import logging
 import math
 import os
 import pkg_resources
 import re
 import shutil
+import sqlite3
+import stat
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from feedgen.feed import FeedGenerator
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from markupsafe import Markup
 
 from .db import User, Message
+from .images import image_file
+from .stats import Stats
 
 
 _NL2BR = re.compile(r"\n\n+")
 
+# Build manifest written to the publish directory that records the
+# fingerprint of every rendered page for incremental builds.
+_MANIFEST = ".manifest.json"
+
+# Markers around the timeline fragment in pages. On incremental builds,
+# the timeline of unchanged pages is replaced between them when the month
+# counts change, instead of rendering the pages again.
+_TIMELINE_START, _TIMELINE_END = "<!-- timeline -->", "<!-- /timeline -->"
+
+# Build instance in a page rendering worker process of a parallel build.
+_worker = None
+
+# Directory in the publish directory with the static search index.
+_SEARCH_DIR = "search"
+
+# Directory in the publish directory with the chunks of messages of
+# pages that are loaded lazily (lazy_pages).
+_DATA_DIR = "data"
+
+# ioctl for cloning a file (reflink) on Linux filesystems that support it.
+_FICLONE = 0x40049409
+
+# SQLite file in cache_dir with the rendered HTML of a group's messages.
+_FRAGMENT_CACHE = "messages-{}.sqlite"
+
+# The process's umask, for the permissions of files written with _write_file().
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Templates loaded in this process by (path, cache directory), shared by
+# the builds of all the groups of a multi-group config.
+_templates = {}
+
+# Published files that get precompressed sidecars (publish_compression)
+# and the extensions of the sidecars of every compression method.
+_COMPRESS_EXTS = (".html", ".xml", ".atom", ".css", ".js", ".json", ".svg", ".txt")
+_COMPRESSED = {"gzip": ".gz", "brotli": ".br"}
+
+# Compressed files in cache_dir that haven't been used for this many
+# days are removed.
+_COMPRESS_CACHE_DAYS = 30
+
 
 class Build:
     config = {}
     template = None
+    template_src = ""
+    template_file = ""
+    template_key = ""
+    fragment_cache = None
     db = None
 
-    def __init__(self, config, db):
+    def __init__(self, config, db, stats=None):
         self.config = config
         self.db = db
+        self.stats = stats or Stats()
 
-        # Map of all message IDs across all months and the slug of the page
-        # in which they occur (paginated), used to link replies to their
-        # parent messages that may be on arbitrary pages.
+        # Map of the IDs of all messages that are replied to, across all
+        # months, and the name of the page in which they occur (paginated),
+        # used to link replies to their parent messages that may be on
+        # arbitrary pages. It's computed before any page is rendered.
         self.page_ids = {}
         self.timeline = OrderedDict()
 
-    def build(self):
+        # Media file -> Image of the thumbnails and sizes made by the image
+        # pipeline, for the srcset and dimensions of media images.
+        self.images = {}
+
+    def build(self, incremental=False, workers=1):
+        """
+        Build the site. If incremental is set and the publish directory
+        has a manifest from a previous build with the same template, config,
+        and list of months, only pages whose data has changed are re-rendered
+        and the rest of the output tree is left untouched.
+
+        If workers > 1, pages are fetched and paginated here and handed off
+        to a pool of worker processes for rendering and writing.
+        """
+        stats = self.stats
+        with stats.phase("build: timeline"):
+            timeline = list(self.db.get_timeline())
+
+        # Pages are only reused if nothing that goes into every page has changed.
+        key = self._make_build_key(timeline)
+        prev = self._load_manifest() if incremental else None
+        if prev and prev.get("key") != key:
+            logging.info("template, config, or timeline changed. rebuilding all pages")
+            prev = None
+
+        # The published search index is kept, also on full builds, if the
+        # DB's index hasn't changed since it was published.
+        search_key, keep = None, []
+        if self.config["publish_search"]:
+            search_key = self._make_search_key(timeline)
+            if self._load_search_key() == search_key:
+                keep.append(_SEARCH_DIR)
+
         # (Re)create the output directory.
-        self._create_publish_dir()
+        with stats.phase("build: publish directory"):
+            self._create_publish_dir(clean=prev is None, keep=keep)
 
-        timeline = list(self.db.get_timeline())
         if len(timeline) == 0:
             logging.info("no data found to publish site")
-            quit()
+            return
 
         for month in timeline:
             if month.date.year not in self.timeline:
                 self.timeline[month.date.year] = []
             self.timeline[month.date.year].append(month)
 
-        # Queue to store the latest N items to publish in the RSS feed.
-        rss_entries = deque([], self.config["rss_feed_entries"])
+        # Pages of every message that's replied to, including replies to
+        # messages on later pages.
+        with stats.phase("build: reply pages"):
+            self.page_ids = {p.id: self.make_filename(p.month, p.page)
+                             for p in self.db.get_message_pages(self.config["per_page"])}
+
+        with stats.phase("build: images"):
+            self.images = {i.file: i for i in self.db.get_images()}
+
+        prev_pages = prev["pages"] if prev else {}
+        prev_timelines = prev.get("timelines", {}) if prev else {}
+        pages, timelines = {}, {}
+        n_rendered = 0
+
+        pool, jobs = None, set()
+        if workers > 1:
+            pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                       initargs=(self.config, self.template_file, self.timeline, self.images))
+
+        # Months with re-rendered pages, and months that changed in the DB
+        # since the last build (like edits and deletions found by a sync),
+        # whose pages are always re-rendered.
+        months = set()
+        dirty = set(self.db.get_dirty_months())
         fname = None
-        for month in timeline:
-            # Get the days + message counts for the month.
-            dayline = OrderedDict()
-            for d in self.db.get_dayline(month.date.year, month.date.month, self.config["per_page"]):
-                dayline[d.slug] = d
+        with stats.phase("build: pages"):
+            for month in timeline:
+                # Get the days + message counts for the month.
+                dayline = OrderedDict()
+                for d in self.db.get_dayline(month.date.year, month.date.month, self.config["per_page"]):
+                    dayline[d.slug] = d
+
+                # Paginate and fetch messages for the month until the end..
+                last_id = 0
+                total = self.db.get_message_count(
+                    month.date.year, month.date.month)
+                total_pages = math.ceil(total / self.config["per_page"])
 
-            # Paginate and fetch messages for the month until the end..
-            page = 0
-            last_id = 0
-            total = self.db.get_message_count(
-                month.date.year, month.date.month)
-            total_pages = math.ceil(total / self.config["per_page"])
+                # Fragments of the template that are the same on every page of
+                # the month.
+                with stats.phase("build: fragments"):
+                    month_fragments = self._render_fragments(["timeline", "dayline"],
+                                                             month, dayline, 1, total_pages)
+                if "timeline" in month_fragments:
+                    month_fragments["timeline"] = Markup(
+                        _TIMELINE_START + str(month_fragments["timeline"]) + _TIMELINE_END)
+                    timelines[month.slug] = hashlib.sha1(
+                        month_fragments["timeline"].encode("utf8")).hexdigest()
 
-            while True:
-                messages = list(self.db.get_messages(month.date.year, month.date.month,
-                                                     last_id, self.config["per_page"]))
+                for page in range(1, total_pages + 1):
+                    p = _Page(self, month, dayline, page, total_pages, last_id)
+                    fname = p.fname
 
-                if len(messages) == 0:
-                    break
+                    # The messages are streamed from the DB while the page is rendered.
+                    # Pages for the worker pool are read in full. Pages that may be
+                    # unchanged since the last build are read first to get their
+                    # fingerprint, and streamed again if they have to be rendered.
+                    if pool:
+                        messages = list(p)
+                    elif fname in prev_pages:
+                        with stats.phase("build: page fingerprints"):
+                            for _ in p:
+                                pass
+                        messages = _Page(self, month, dayline, page, total_pages, last_id)
+                    else:
+                        messages = p
 
-                last_id = messages[-1].id
+                    # Skip rendering if the page's inputs are identical to the last build.
+                    # If only the month counts in the timeline changed, the page's
+                    # timeline is replaced.
+                    if fname in prev_pages and prev_pages[fname] == p.key and month.slug not in dirty and \
+                            (prev_timelines.get(month.slug) == timelines.get(month.slug) or
+                             self._replace_timeline(fname, month_fragments["timeline"])):
+                        pages[fname] = p.key
+                        last_id = p.last_id
+                        stats.count("pages skipped")
+                        continue
 
-                page += 1
-                fname = self.make_filename(month, page)
+                    n_rendered += 1
+                    months.add(month.slug)
+                    stats.count("pages rendered")
 
-                # Collect the message ID -> page name for all messages in the set
-                # to link to replies in arbitrary positions across months, paginated pages.
-                for m in messages:
-                    self.page_ids[m.id] = fname
+                    with stats.phase("build: fragments"):
+                        fragments = {**month_fragments,
+                                     **self._render_fragments(["pagination"], month, dayline, page, total_pages)}
 
-                if self.config["publish_rss_feed"]:
-                    rss_entries.extend(messages)
+                    if not pool:
+                        with stats.phase("build: render and write"):
+                            stats.count("bytes written", self._render_page(
+                                messages, month, dayline, fname, page, total_pages,
+                                messages.reply_ids, fragments))
+                    else:
+                        # Limit the number of queued pages to keep memory in check.
+                        # Only the reply links the page needs are sent to the worker.
+                        if len(jobs) >= workers * 2:
+                            jobs = self._wait_jobs(jobs, FIRST_COMPLETED)
+                        jobs.add(pool.submit(_render_page_worker, messages, month, dayline,
+                                             fname, page, total_pages, p.reply_ids, fragments))
 
-                self._render_page(messages, month, dayline,
-                                  fname, page, total_pages)
+                    pages[fname] = p.key
+                    last_id = p.last_id
+
+            if pool:
+                with stats.phase("build: wait for workers"):
+                    self._wait_jobs(jobs)
+                pool.shutdown()
+
+        # Remove pages from the previous build that no longer exist.
+        for f in prev_pages:
+            if f not in pages and os.path.exists(os.path.join(self.config["publish_dir"], f)):
+                os.remove(os.path.join(self.config["publish_dir"], f))
+                self._remove_chunks(f)
+
+        self._save_manifest(key, pages, timelines)
+        if incremental:
+            logging.info("rendered {} of {} pages".format(n_rendered, len(pages)))
 
         # The last page chronologically is the latest page. Make it index.
         if fname:
@@ -90,44 +270,261 @@ class Build:
 
         # Generate RSS feeds.
         if self.config["publish_rss_feed"]:
-            self._build_rss(rss_entries, "index.rss", "index.atom")
+            with stats.phase("build: feeds"):
+                self._build_feeds(months)
+
+        # Generate the static search index.
+        if self.config["publish_search"]:
+            if _SEARCH_DIR in keep:
+                logging.info("search index unchanged")
+            else:
+                with stats.phase("build: search index"):
+                    self._build_search(search_key)
+
+        # Precompress text files for static serving.
+        if self.config["publish_compression"]:
+            with stats.phase("build: compress"):
+                self._compress_files()
+
+        self.db.clear_dirty_months()
 
     def load_template(self, fname):
         with open(fname, "r") as f:
-            self.template = Template(f.read())
+            self.template_src = f.read()
+        self.template_file = fname
+
+        # Compiled templates are cached in cache_dir across builds, and
+        # recompiled only when their source changes.
+        cache, cdir = None, None
+        if self.config.get("cache_dir"):
+            cdir = os.path.join(self.config["cache_dir"], "templates")
+            os.makedirs(cdir, exist_ok=True)
+            cache = FileSystemBytecodeCache(cdir)
+
+        key = (os.path.abspath(fname), cdir)
+        if key in _templates and _templates[key][0] == self.template_src:
+            self.template = _templates[key][1]
+        else:
+            env = Environment(loader=FileSystemLoader(os.path.dirname(os.path.abspath(fname))),
+                              bytecode_cache=cache)
+            self.template = env.get_template(os.path.basename(fname))
+            _templates[key] = (self.template_src, self.template)
+
+        # Fingerprint of the inputs common to every message's HTML.
+        h = hashlib.sha1(self.template_src.encode("utf8"))
+        h.update(json.dumps(self.config, sort_keys=True, default=str).encode("utf8"))
+        self.template_key = h.hexdigest()
+
+        # Messages are rendered with the template's "message" block and cached.
+        if cache and "message" in self.template.blocks:
+            group = re.sub(r"[^\w-]", "_", str(self.config["group"]))
+            self.fragment_cache = _FragmentCache(
+                os.path.join(self.config["cache_dir"], _FRAGMENT_CACHE.format(group)))
 
     def make_filename(self, month, page) -> str:
         fname = "{}{}.html".format(
             month.slug, "_" + str(page) if page > 1 else "")
         return fname
 
-    def _render_page(self, messages, month, dayline, fname, page, total_pages):
-        html = self.template.render(config=self.config,
-                                    timeline=self.timeline,
-                                    dayline=dayline,
-                                    month=month,
-                                    messages=messages,
-                                    page_ids=self.page_ids,
-                                    pagination={"current": page,
-                                                "total": total_pages},
-                                    make_filename=self.make_filename,
-                                    nl2br=self._nl2br)
-
-        with open(os.path.join(self.config["publish_dir"], fname), "w", encoding='utf8') as f:
-            f.write(html)
-
-    def _build_rss(self, messages, rss_file, atom_file):
+    def _render_page(self, messages, month, dayline, fname, page, total_pages, page_ids,
+                     fragments=None):
+        """
+        Render a page and write it to disk as it's being rendered. messages
+        can be any iterable, including a _Page that streams from the DB.
+        page_ids has the pages of the messages replied to on the page, and can
+        be filled in as the messages are consumed. fragments are pre-rendered
+        blocks of the template from _render_fragments(). Returns the size of
+        the page in bytes.
+
+        With lazy_pages, only the first chunk of messages is rendered into the
+        page and the rest are written to data files (see _write_chunks()).
+        """
+        page_vars = self._page_vars(month, dayline, page, total_pages)
+
+        fragments = dict(fragments or {})
+        if self.fragment_cache:
+            fragments["message"] = self._message_renderer(page_vars, page_ids)
+
+        chunks = None
+        if self.config["lazy_pages"] and "messages" in self.template.blocks:
+            messages, chunks = self._write_chunks(messages, fname, page_vars, page_ids, fragments)
+
+        stream = self.template.stream(messages=messages,
+                                      page_ids=page_ids,
+                                      fragments=fragments,
+                                      chunks=chunks,
+                                      **page_vars)
+
+        path = os.path.join(self.config["publish_dir"], fname)
+        with open(path, "w", encoding='utf8') as f:
+            stream.dump(f)
+
+        if self.fragment_cache:
+            self.fragment_cache.flush()
+        return os.path.getsize(path)
+
+    def _write_chunks(self, messages, fname, page_vars, page_ids, fragments):
+        """
+        Split a page's messages into chunks of lazy_chunk_size messages and
+        write every chunk but the first, rendered with the template's messages
+        block, into a JSON data file that static/main.js loads as the page is
+        scrolled. The messages are consumed as they're streamed. Returns the
+        first chunk of messages and the list of the other chunks' files, with
+        their first and last message IDs and the days that start in them, for
+        main.js to find the chunk of a linked message or day.
+        """
+        size = max(1, self.config["lazy_chunk_size"])
+        name = os.path.splitext(fname)[0]
+        os.makedirs(os.path.join(self.config["publish_dir"], _DATA_DIR), exist_ok=True)
+
+        it = iter(messages)
+        first = list(islice(it, size))
+
+        ctx = self.template.new_context({**page_vars, "messages": [], "page_ids": page_ids,
+                                         "fragments": fragments, "chunks": None,
+                                         "prev_message": None})
+        block = self.template.blocks["messages"]
+
+        chunks = []
+        prev = first[-1] if first else None
+        while True:
+            chunk = list(islice(it, size))
+            if not chunk:
+                break
+
+            ctx.vars["messages"] = chunk
+            ctx.vars["prev_message"] = prev
+            html = "".join(block(ctx))
+
+            days = []
+            for m in chunk:
+                if m.date.date() != prev.date.date():
+                    days.append(m.date.strftime("%Y-%m-%d"))
+                prev = m
+
+            url = "{}/{}-{}.json".format(_DATA_DIR, name, len(chunks) + 1)
+            b = json.dumps({"html": html}, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+            with open(os.path.join(self.config["publish_dir"], url), "wb") as f:
+                f.write(b)
+            self.stats.count("bytes written", len(b))
+
+            chunks.append({"url": url, "first": chunk[0].id, "last": chunk[-1].id, "days": days})
+
+        # Remove the chunks of the page from a previous build that had more.
+        self._remove_chunks(fname, len(chunks) + 1)
+        return first, chunks
+
+    def _remove_chunks(self, fname, start=1):
+        """Remove the data files of the chunks of a page from number start onwards."""
+        name = os.path.splitext(fname)[0]
+        n = start
+        while True:
+            path = os.path.join(self.config["publish_dir"], _DATA_DIR, "{}-{}.json".format(name, n))
+            if not os.path.exists(path):
+                break
+            os.remove(path)
+            n += 1
+
+    def _message_renderer(self, page_vars, page_ids):
+        """
+        Return a function for the template that returns the HTML of a message
+        from the fragment cache, or renders the template's message block for
+        it and caches it. A message's HTML is keyed by everything that goes
+        into it: the message itself (edits, user, media ...), the page of the
+        message it replies to, and the template and config.
+        """
+        ctx = self.template.new_context({**page_vars, "messages": [],
+                                         "page_ids": page_ids, "fragments": {}})
+        block = self.template.blocks["message"]
+
+        def render(m):
+            reply = page_ids.get(m.reply_to) if m.reply_to else None
+            key = hashlib.sha1("{}{!r}".format(
+                self.template_key, (m, reply)).encode("utf8")).hexdigest()
+
+            html = self.fragment_cache.get(m.id, key)
+            if html is None:
+                ctx.vars["m"] = m
+                html = "".join(block(ctx))
+                self.fragment_cache.put(m.id, key, html)
+                self.stats.count("messages rendered")
+            else:
+                self.stats.count("messages from cache")
+            return Markup(html)
+        return render
+
+    def _render_fragments(self, names, month, dayline, page, total_pages):
+        """
+        Pre-render the named blocks of the template that are the same on
+        many pages, like the timeline on every page of a month. They're passed
+        to the pages as fragments that the template outputs instead of
+        rendering the blocks again. Blocks the template doesn't have are skipped.
+        """
+        ctx = self.template.new_context({**self._page_vars(month, dayline, page, total_pages),
+                                         "messages": [], "page_ids": {}, "fragments": {}})
+        return {n: Markup("".join(self.template.blocks[n](ctx)))
+                for n in names if n in self.template.blocks}
+
+    def _page_vars(self, month, dayline, page, total_pages):
+        return {"config": self.config,
+                "timeline": self.timeline,
+                "dayline": dayline,
+                "month": month,
+                "pagination": {"current": page, "total": total_pages},
+                "make_filename": self.make_filename,
+                "media_url": os.path.basename(self.config["media_dir"]),
+                "images": self.images,
+                "image_file": image_file,
+                "nl2br": self._nl2br}
+
+    def _build_feeds(self, months):
+        """
+        Generate the site's feed of the latest messages, and optionally, feeds
+        of the latest messages of every month (only the given months that have
+        changed) and every user.
+        """
+        n = self.config["rss_feed_entries"]
+        site_name = self.config["site_name"].format(group=self.config["group"])
+
+        # (messages, rss file, atom file, title) of every feed.
+        feeds = [(list(self.db.get_last_messages(n)), "index.xml", "index.atom", None)]
+
+        if self.config["rss_feed_months"]:
+            for slug, messages in groupby(self.db.get_last_messages(n, per="month"),
+                                          key=lambda m: m.date.strftime("%Y-%m")):
+                if slug in months:
+                    feeds.append((list(messages), slug + ".xml", slug + ".atom",
+                                  "{} ({})".format(site_name, slug)))
+
+        if self.config["rss_feed_users"]:
+            for _, messages in groupby(self.db.get_last_messages(n, per="user"),
+                                       key=lambda m: m.user.id):
+                messages = list(messages)
+                username = messages[0].user.username
+                feeds.append((messages, "user_{}.xml".format(username),
+                              "user_{}.atom".format(username),
+                              "{} (@{})".format(site_name, username)))
+
+        # The pages of the entries of all the feeds are looked up in one pass.
+        ids = {m.id for f in feeds for m in f[0]}
+        pages = {p.id: self.make_filename(p.month, p.page)
+                 for p in self.db.get_message_pages(self.config["per_page"], ids)}
+
+        for messages, rss_file, atom_file, title in feeds:
+            self._build_rss(messages, pages, rss_file, atom_file, title)
+
+    def _build_rss(self, messages, pages, rss_file, atom_file, title=None):
+        """Write the RSS and Atom feeds of messages. pages has the page of every message."""
         f = FeedGenerator()
         f.id(self.config["site_url"])
         f.generator(
             "tg-archive {}".format(pkg_resources.get_distribution("tg-archive").version))
         f.link(href=self.config["site_url"], rel="alternate")
-        f.title(self.config["site_name"].format(group=self.config["group"]))
+        f.title(title or self.config["site_name"].format(group=self.config["group"]))
         f.subtitle(self.config["site_description"])
 
         for m in messages:
-            url = "{}/{}#{}".format(self.config["site_url"],
-                                    self.page_ids[m.id], m.id)
+            url = "{}/{}#{}".format(self.config["site_url"], pages[m.id], m.id)
             e = f.add_entry()
             e.id(url)
             e.title("@{} on {} (#{})".format(m.user.username, m.date, m.id))
@@ -138,9 +535,215 @@ class Build:
                                          os.path.basename(self.config["media_dir"]), m.media.url)
                 e.enclosure(murl, 0, "application/octet-stream")
 
-            f.rss_file(os.path.join(self.config["publish_dir"], "index.xml"))
-            f.atom_file(os.path.join(
-                self.config["publish_dir"], "index.atom"))
+        # Write the feeds once all the entries are in.
+        f.rss_file(os.path.join(self.config["publish_dir"], rss_file))
+        f.atom_file(os.path.join(self.config["publish_dir"], atom_file))
+        self.stats.count("bytes written",
+                         os.path.getsize(os.path.join(self.config["publish_dir"], rss_file)) +
+                         os.path.getsize(os.path.join(self.config["publish_dir"], atom_file)))
+
+    def _build_search(self, key):
+        """
+        Write the DB's search index as static files that static/main.js loads
+        lazily. The terms, in order, are split into shards of about
+        search_shard_size message IDs each, and index.json lists the first
+        term of every shard so that a browser only fetches the shards with
+        the terms (or prefixes) it's looking for. Message IDs in the shards
+        are delta encoded, and index.json maps ID ranges to pages.
+        Unchanged shards are not rewritten. index.json also records the key
+        of the index (_make_search_key()).
+        """
+        sdir = os.path.join(self.config["publish_dir"], _SEARCH_DIR)
+        os.makedirs(sdir, exist_ok=True)
+
+        pages = [[r.first_id, r.last_id, self.make_filename(r.month, r.page)]
+                 for r in self.db.get_page_ranges(self.config["per_page"])]
+
+        shards, files = [], set()
+        shard, size = {}, 0
+        for term, ids in self.db.get_search_terms():
+            if size >= self.config["search_shard_size"]:
+                files.add(self._write_search_file(
+                    sdir, "{}.json".format(len(shards) - 1), shard))
+                shard, size = {}, 0
+
+            if not shard:
+                shards.append(term)
+            shard[term] = [ids[0]] + [b - a for a, b in zip(ids, ids[1:])]
+            size += len(ids)
+
+        if shard:
+            files.add(self._write_search_file(
+                sdir, "{}.json".format(len(shards) - 1), shard))
+
+        files.add(self._write_search_file(sdir, "index.json",
+                                          {"shards": shards, "pages": pages, "key": key}))
+
+        # Remove shards from the previous build that no longer exist.
+        for f in os.listdir(sdir):
+            if f not in files:
+                os.remove(os.path.join(sdir, f))
+
+        self.stats.count("search shards", len(shards))
+        logging.info("published search index: {} shards".format(len(shards)))
+
+    def _make_search_key(self, timeline) -> str:
+        """
+        Make a fingerprint of the inputs of the search index: the DB's search
+        index version, the month counts and the pagination, which the page
+        ranges in index.json depend on.
+        """
+        return hashlib.sha1(repr((self.db.get_search_version(),
+                                  [(m.slug, m.count) for m in timeline],
+                                  self.config["per_page"],
+                                  self.config["search_shard_size"])).encode("utf8")).hexdigest()
+
+    def _load_search_key(self):
+        """Get the key of the published search index, if any."""
+        try:
+            with open(os.path.join(self.config["publish_dir"], _SEARCH_DIR, "index.json"), "rb") as f:
+                return json.load(f).get("key")
+        except (OSError, ValueError):
+            return None
+
+    def _write_search_file(self, sdir, fname, data):
+        """Write a search index file if its contents have changed and return its name."""
+        b = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+        path = os.path.join(sdir, fname)
+        try:
+            with open(path, "rb") as f:
+                if f.read() == b:
+                    return fname
+        except OSError:
+            pass
+
+        with open(path, "wb") as f:
+            f.write(b)
+        self.stats.count("bytes written", len(b))
+        return fname
+
+    def _compress_files(self):
+        """
+        Write compressed sidecars (eg: index.html.gz) of the text files in the
+        publish directory with the publish_compression methods, for servers
+        that serve precompressed files (like nginx's gzip_static). Files are
+        compressed in a thread pool. Sidecars that are newer than their file
+        are left as they are. The compressed files are also kept in cache_dir
+        by the hash of their contents so that files that are rewritten with
+        the same contents, like every page on a full build, are not
+        compressed again. Sidecars of files that no longer exist are removed.
+        """
+        methods = []
+        for m in self.config["publish_compression"]:
+            if m not in _COMPRESSED:
+                logging.error("unknown publish_compression method: {}".format(m))
+            elif m == "brotli" and not brotli:
+                logging.error("brotli compression needs the brotli package (pip install brotli)")
+            else:
+                methods.append(m)
+        if not methods:
+            return
+
+        cdir = None
+        if self.config.get("cache_dir"):
+            cdir = os.path.join(self.config["cache_dir"], "compressed")
+
+        pubdir = self.config["publish_dir"]
+        pubmedia = os.path.join(pubdir, os.path.basename(self.config["media_dir"]))
+        sidecars = tuple(_COMPRESSED[m] for m in methods)
+        files = []
+        for root, dirs, fnames in os.walk(pubdir):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != pubmedia]
+            for f in fnames:
+                path = os.path.join(root, f)
+
+                # Remove the sidecars of deleted files. Other .gz and .br files,
+                # like archives copied from static_dir, aren't sidecars.
+                src = os.path.splitext(path)[0]
+                if f.endswith(tuple(_COMPRESSED.values())) and src.endswith(_COMPRESS_EXTS) and \
+                        not os.path.basename(src).startswith("."):
+                    if not os.path.exists(src):
+                        os.remove(path)
+                    continue
+
+                if not f.endswith(_COMPRESS_EXTS) or f.startswith("."):
+                    continue
+
+                mtime = os.stat(path).st_mtime
+                if all(_is_newer(path + ext, mtime) for ext in sidecars):
+                    continue
+                files.append(path)
+
+        n = 0
+        with ThreadPoolExecutor() as pool:
+            for cached in pool.map(lambda f: _compress_file(f, methods, cdir), files):
+                n += 1
+                self.stats.count("files compressed")
+                self.stats.count("compressed from cache", cached)
+
+        if cdir and os.path.isdir(cdir):
+            _prune_files(cdir, time.time() - _COMPRESS_CACHE_DAYS * 86400)
+
+        logging.info("compressed {} files ({})".format(n, ", ".join(methods)))
+
+    def _wait_jobs(self, jobs, return_when=ALL_COMPLETED):
+        """Wait for pages being rendered in the pool and return the pending ones."""
+        done, pending = wait(jobs, return_when=return_when)
+
+        # Raise exceptions from workers, if any.
+        for f in done:
+            self.stats.count("bytes written", f.result())
+        return pending
+
+    def _make_build_key(self, timeline) -> str:
+        """
+        Make a fingerprint of the inputs common to all pages. If the template
+        has a timeline block, month message counts are left out so that new
+        messages in the latest month don't invalidate every page. The
+        timeline of unchanged pages is replaced instead (_replace_timeline()).
+        """
+        h = hashlib.sha1()
+        h.update(self.template_src.encode("utf8"))
+        h.update(json.dumps(self.config, sort_keys=True, default=str).encode("utf8"))
+        if "timeline" in self.template.blocks:
+            h.update(repr([m.slug for m in timeline]).encode("utf8"))
+        else:
+            h.update(repr([(m.slug, m.count) for m in timeline]).encode("utf8"))
+        return h.hexdigest()
+
+    def _replace_timeline(self, fname, timeline) -> bool:
+        """
+        Replace the timeline of a published page with the given timeline
+        fragment. Returns False if the page has no timeline markers, like
+        pages of builds before they were added, and has to be rendered.
+        """
+        path = os.path.join(self.config["publish_dir"], fname)
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                html = f.read()
+        except OSError:
+            return False
+
+        start = html.find(_TIMELINE_START)
+        end = html.find(_TIMELINE_END, start)
+        if start < 0 or end < 0:
+            return False
+
+        html = html[:start] + str(timeline) + html[end + len(_TIMELINE_END):]
+        _write_file(path, html.encode("utf8"))
+        self.stats.count("timelines replaced")
+        return True
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.config["publish_dir"], _MANIFEST), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_manifest(self, key, pages, timelines):
+        with open(os.path.join(self.config["publish_dir"], _MANIFEST), "w") as f:
+            json.dump({"key": key, "pages": pages, "timelines": timelines}, f)
 
     def _make_abstract(self, m):
         out = m.content
@@ -153,15 +756,23 @@ class Build:
         # Jinja's automatic hyperlinking of URLs.
         return _NL2BR.sub("\n\n", s).replace("\n", "\n<br />")
 
-    def _create_publish_dir(self):
+    def _create_publish_dir(self, clean=True, keep=()):
         pubdir = self.config["publish_dir"]
+        pubmedia = os.path.join(pubdir, os.path.basename(self.config["media_dir"]))
 
-        # Clear the output directory.
-        if os.path.exists(pubdir):
-            shutil.rmtree(pubdir)
+        # Clear the output directory, except for the published media
+        # which is synced separately, and the given files to keep.
+        if clean and os.path.exists(pubdir):
+            for f in os.scandir(pubdir):
+                if f.path == pubmedia or f.name in keep:
+                    continue
+                if f.is_dir(follow_symlinks=False):
+                    shutil.rmtree(f.path)
+                else:
+                    os.remove(f.path)
 
         # Re-create the output directory.
-        os.mkdir(pubdir)
+        os.makedirs(pubdir, exist_ok=True)
 
         # Copy the static directory into the output directory.
         for f in [self.config["static_dir"]]:
@@ -169,10 +780,266 @@ class Build:
             if os.path.isfile(f):
                 shutil.copyfile(f, target)
             else:
-                shutil.copytree(f, target)
+                shutil.copytree(f, target, dirs_exist_ok=True)
+
+        # If media downloading is enabled, publish the media directory.
+        if os.path.exists(self.config["media_dir"]):
+            with self.stats.phase("build: publish media"):
+                self._publish_media(self.config["media_dir"], pubmedia)
+        elif os.path.exists(pubmedia):
+            shutil.rmtree(pubmedia)
+
+    def _publish_media(self, src, dst):
+        """
+        Sync the media directory to the publish directory by linking new or
+        changed files (by size and mtime) with the media_publish_mode method,
+        falling back to the next one in hardlink -> reflink -> symlink -> copy
+        if it's not supported. Files that no longer exist in the media
+        directory are removed.
+        """
+        methods = [_hardlink, _reflink, _symlink, _copy]
+        mode = {"link": _hardlink, "reflink": _reflink,
+                "symlink": _symlink, "copy": _copy}[self.config["media_publish_mode"]]
+        methods = methods[methods.index(mode):]
+
+        n_new, n_removed = 0, 0
+        for root, dirs, files in os.walk(src):
+            # Skip hidden directories, like the one of in-progress downloads.
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+
+            target = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target, exist_ok=True)
+
+            for f in files:
+                sfile, dfile = os.path.join(root, f), os.path.join(target, f)
+                if _is_published(sfile, dfile):
+                    continue
+
+                if os.path.lexists(dfile):
+                    os.remove(dfile)
+
+                # Drop methods that don't work here for the rest of the files.
+                while True:
+                    try:
+                        methods[0](sfile, dfile)
+                        break
+                    except OSError as e:
+                        if len(methods) == 1:
+                            raise
+                        logging.info("unable to {} media ({}). falling back to {}".format(
+                            methods[0].__name__[1:], e, methods[1].__name__[1:]))
+                        methods.pop(0)
+                n_new += 1
+
+        # Remove published files and directories that are no longer in the source.
+        for root, dirs, files in os.walk(dst, topdown=False):
+            source = os.path.join(src, os.path.relpath(root, dst))
+            for f in files:
+                if not os.path.lexists(os.path.join(source, f)):
+                    os.remove(os.path.join(root, f))
+                    n_removed += 1
+            for d in dirs:
+                if not os.path.isdir(os.path.join(source, d)):
+                    shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+
+        self.stats.count("media published", n_new)
+        self.stats.count("media removed", n_removed)
+        logging.info("published media: {} new or changed, {} removed".format(n_new, n_removed))
+
+
+class _FragmentCache:
+    """
+    _FragmentCache stores the rendered HTML of messages by message ID in a
+    SQLite file, with the key of the inputs it was rendered from. New
+    entries are written in batches with flush(). The file can be shared by
+    the processes of a parallel build.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS fragments (
+            id INTEGER PRIMARY KEY, key TEXT NOT NULL, html TEXT NOT NULL)""")
+        self.conn.commit()
+        self.pending = []
+
+    def get(self, id, key):
+        """Get the HTML of a message if it's cached with the given key."""
+        r = self.conn.execute("SELECT html FROM fragments WHERE id = ? AND key = ?",
+                              (id, key)).fetchone()
+        return r[0] if r else None
+
+    def put(self, id, key, html):
+        self.pending.append((id, key, html))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO fragments (id, key, html) VALUES(?, ?, ?)",
+                                  self.pending)
+        self.pending = []
+
+
+class _Page:
+    """
+    _Page iterates over a page's messages from the DB without holding them in
+    memory. As the messages are consumed, it records the page's reply links,
+    last message ID, and fingerprint of the page-specific data that goes into
+    the page.
+    """
+
+    def __init__(self, build, month, dayline, page, total_pages, last_id):
+        self.build = build
+        self.month = month
+        self.fname = build.make_filename(month, page)
+        self.start_id = last_id
+        self.last_id = last_id
+        self.head = (month, list(dayline.values()), page, total_pages)
+
+        # Reply message ID -> page name of the messages replied to on the page.
+        self.reply_ids = {}
+        self.key = None
+
+        # The last few messages consumed, which templates written for
+        # fully loaded pages can still access with messages[index].
+        self._recent = deque([], 2)
+
+    def __getitem__(self, i):
+        for n, m in self._recent:
+            if n == i:
+                return m
+        raise IndexError("only the latest messages of a streamed page can be accessed")
+
+    def __iter__(self):
+        h = hashlib.sha1(repr(self.head).encode("utf8"))
+        for n, m in enumerate(self.build.db.get_messages(self.month.date.year, self.month.date.month,
+                                                         self.start_id, self.build.config["per_page"])):
+            self._recent.append((n, m))
+
+            reply = self.build.page_ids.get(m.reply_to) if m.reply_to else None
+            if reply:
+                self.reply_ids[m.reply_to] = reply
+
+            h.update(repr((m, reply)).encode("utf8"))
+            self.last_id = m.id
+            yield m
+
+        self.key = h.hexdigest()
+
+
+def _is_published(src, dst) -> bool:
+    """Check if dst is an up-to-date link or copy of src."""
+    try:
+        d = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+
+    if stat.S_ISLNK(d.st_mode):
+        return os.readlink(dst) == os.path.abspath(src)
+
+    s = os.stat(src)
+    if (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino):
+        return True
+    return s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime)
+
+
+def _is_newer(path, mtime) -> bool:
+    try:
+        return os.stat(path).st_mtime >= mtime
+    except FileNotFoundError:
+        return False
+
+
+def _compress_file(path, methods, cdir=None) -> int:
+    """
+    Write the compressed sidecars of the file path with the given methods.
+    If cdir is set, compressed files are reused from and saved to it by the
+    hash of the file's contents. Returns the number of sidecars that came
+    from cdir.
+    """
+    with open(path, "rb") as f:
+        b = f.read()
+    digest = hashlib.sha1(b).hexdigest()
+
+    n = 0
+    for m in methods:
+        ext = _COMPRESSED[m]
+        cached = os.path.join(cdir, digest[:2], digest + ext) if cdir else None
+        if cached and os.path.exists(cached):
+            # Mark the cached file as used.
+            os.utime(cached)
+            shutil.copyfile(cached, path + ext)
+            n += 1
+            continue
+
+        if m == "gzip":
+            out = gzip.compress(b, compresslevel=9, mtime=0)
+        else:
+            out = brotli.compress(b, mode=brotli.MODE_TEXT)
+
+        _write_file(path + ext, out)
+        if cached:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            _write_file(cached, out)
+    return n
+
+
+def _write_file(path, b):
+    """Write a file atomically by writing it to a temporary file and renaming it."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(b)
+
+    # mkstemp() files are private (0600). Give it the permissions of files
+    # created with open().
+    os.chmod(tmp, 0o666 & ~_UMASK)
+    os.replace(tmp, path)
+
+
+def _prune_files(dir, before):
+    """Remove files in dir (recursively) last modified before the timestamp before."""
+    for root, _, files in os.walk(dir):
+        for f in files:
+            path = os.path.join(root, f)
+            if os.stat(path).st_mtime < before:
+                os.remove(path)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    if not fcntl:
+        raise OSError("reflinks are not supported on this platform")
+
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+def _copy(src, dst):
+    shutil.copy2(src, dst)
+
+
+def _init_worker(config, template_file, timeline, images):
+    """Initialize the Build instance in a rendering worker process."""
+    global _worker
+    _worker = Build(config, None)
+    _worker.load_template(template_file)
+    _worker.timeline = timeline
+    _worker.images = images
+
 
-        # If media downloading is enabled, copy the media directory.
-        mediadir = self.config["media_dir"]
-        if os.path.exists(mediadir):
-            shutil.copytree(mediadir, os.path.join(
-                pubdir, os.path.basename(mediadir)))
+def _render_page_worker(messages, month, dayline, fname, page, total_pages, page_ids, fragments):
+    return _worker._render_page(messages, month, dayline, fname, page, total_pages, page_ids, fragments)
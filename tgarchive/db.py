@@ -1,10 +1,11 @@
+import hashlib
 import json
 import math
 import os
 import sqlite3
 from collections import namedtuple
 from datetime import datetime
-import json
+from itertools import groupby
 from typing import Iterator
 
 schema = """
@@ -40,6 +41,160 @@ CREATE table media (
 );
 """
 
+# Schema migrations that are applied in order to new and existing DBs.
+# The number of migrations applied to a DB is stored in its user_version.
+migrations = [
+    # Precomputed yyyymm month column with an index for range scans.
+    """
+    ALTER TABLE messages ADD COLUMN month INTEGER;
+    UPDATE messages SET month = CAST(strftime('%Y%m', date) AS INTEGER);
+    CREATE INDEX idx_messages_month ON messages(month, id);
+    """,
+
+    # Pending media and avatar downloads that survive interrupted syncs.
+    # kind is media (id = media id) or avatar (id = user id). message_id is
+    # the message to re-fetch from Telegram to resume the download.
+    """
+    CREATE TABLE downloads (
+        kind TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        PRIMARY KEY (kind, id)
+    );
+    """,
+
+    # Full text search index of message content and media titles and
+    # descriptions (poll options for polls). rowid is the message id.
+    """
+    CREATE VIRTUAL TABLE messages_search USING fts5(
+        content, title, description,
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+    INSERT INTO messages_search (rowid, content, title, description)
+        SELECT messages.id, messages.content, media.title,
+            CASE WHEN media.type = 'poll' THEN (
+                SELECT GROUP_CONCAT(JSON_EXTRACT(value, '$.label'), ' ')
+                FROM JSON_EACH(media.description)
+            ) ELSE media.description END
+        FROM messages LEFT JOIN media ON (media.id = messages.media_id);
+    """,
+
+    # Downloaded user avatars and the Telegram photo IDs they were
+    # downloaded from. file is NULL for users without a profile photo.
+    """
+    CREATE TABLE avatars (
+        user_id INTEGER NOT NULL PRIMARY KEY,
+        photo_id INTEGER,
+        file TEXT
+    );
+    """,
+
+    # Files in the content addressed media store by their Telegram photo
+    # or document ID, shared by all the media that have the same file.
+    # file and thumb are paths in the media directory, and title is the
+    # original filename.
+    """
+    CREATE TABLE media_files (
+        file_id INTEGER NOT NULL PRIMARY KEY,
+        file TEXT NOT NULL,
+        title TEXT,
+        thumb TEXT
+    );
+    """,
+
+    # Message ID ranges of backfills and their checkpoints, the last
+    # message ID fetched in the range.
+    """
+    CREATE TABLE sync_state (
+        range_start INTEGER NOT NULL PRIMARY KEY,
+        range_end INTEGER NOT NULL,
+        offset_id INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+
+    # Hash of the message content for finding edits, messages that were
+    # deleted on Telegram, and months with changes since the last build.
+    """
+    ALTER TABLE messages ADD COLUMN hash TEXT;
+    CREATE TABLE deleted_messages (
+        id INTEGER NOT NULL PRIMARY KEY,
+        month INTEGER NOT NULL,
+        deleted_at TIMESTAMP NOT NULL
+    );
+    CREATE TABLE dirty_months (
+        month INTEGER NOT NULL PRIMARY KEY
+    );
+    """,
+
+    # Thumbnails and responsive sizes made from downloaded media images,
+    # by the media file. Files that aren't images have no sizes.
+    """
+    CREATE TABLE images (
+        file TEXT NOT NULL PRIMARY KEY,
+        width INTEGER,
+        height INTEGER,
+        sizes TEXT NOT NULL,
+        thumb TEXT
+    );
+    """,
+
+    # Version of the search index, incremented on every write to it, by
+    # which builds skip publishing an unchanged index.
+    """
+    CREATE TABLE search_version (
+        version INTEGER NOT NULL
+    );
+    INSERT INTO search_version (version) VALUES (0);
+    """,
+]
+
+# Columns selected for making Message() objects with _make_message(). Users
+# come from the DB's user cache. Dates are selected as text to skip sqlite3's
+# timestamp converter and are parsed in _make_message().
+_MESSAGE_COLS = """messages.id, messages.type,
+    CAST(messages.date AS TEXT), CAST(messages.edit_date AS TEXT),
+    messages.content, messages.reply_to, messages.user_id,
+    media.id, media.type, media.url, media.title, media.description, media.thumb"""
+
+# Avatars are only ever set here, and cleared by set_avatar().
+_INSERT_USER = """INSERT INTO users (id, username, first_name, last_name, tags, avatar)
+    VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT (id)
+    DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
+        last_name=excluded.last_name, tags=excluded.tags,
+        avatar=COALESCE(excluded.avatar, users.avatar)
+"""
+
+_INSERT_MEDIA_FILE = """INSERT OR REPLACE INTO media_files (file_id, file, title, thumb)
+    VALUES(?, ?, ?, ?)"""
+
+_INSERT_IMAGE = """INSERT OR REPLACE INTO images (file, width, height, sizes, thumb)
+    VALUES(?, ?, ?, ?, ?)"""
+
+_INSERT_AVATAR = """INSERT OR REPLACE INTO avatars (user_id, photo_id, file)
+    VALUES(?, ?, ?)"""
+
+_INSERT_MEDIA = """INSERT OR REPLACE INTO media
+    (id, type, url, title, description, thumb)
+    VALUES(?, ?, ?, ?, ?, ?)"""
+
+_INSERT_DOWNLOAD = """INSERT OR IGNORE INTO downloads
+    (kind, id, message_id) VALUES(?, ?, ?)"""
+
+_INSERT_MESSAGE = """INSERT OR REPLACE INTO messages
+    (id, type, date, month, edit_date, content, reply_to, user_id, media_id, hash)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+_INSERT_DIRTY_MONTH = "INSERT OR IGNORE INTO dirty_months (month) VALUES(?)"
+
+_UPDATE_SEARCH_VERSION = "UPDATE search_version SET version = version + 1"
+
+_INSERT_SEARCH = """INSERT OR REPLACE INTO messages_search
+    (rowid, content, title, description)
+    VALUES(?, ?, ?, ?)"""
+
 User = namedtuple(
     "User", ["id", "username", "first_name", "last_name", "tags", "avatar"])
 
@@ -49,24 +204,65 @@ Message = namedtuple(
 Media = namedtuple(
     "Media", ["id", "type", "url", "title", "description", "thumb"])
 
+Download = namedtuple(
+    "Download", ["kind", "id", "message_id", "attempts"])
+
+Avatar = namedtuple("Avatar", ["user_id", "photo_id", "file"])
+
+MediaFile = namedtuple("MediaFile", ["file_id", "file", "title", "thumb"])
+
+# sizes is the list of [width, height] of the image's responsive sizes.
+Image = namedtuple("Image", ["file", "width", "height", "sizes", "thumb"])
+
+SyncRange = namedtuple("SyncRange", ["start", "end", "offset_id", "done"])
+
 Month = namedtuple("Month", ["date", "slug", "label", "count"])
 
 Day = namedtuple("Day", ["date", "slug", "label", "count", "page"])
 
+PageRange = namedtuple("PageRange", ["month", "page", "first_id", "last_id"])
+
+MessagePage = namedtuple("MessagePage", ["id", "month", "page"])
+
 
 def _page(n, multiple):
     return math.ceil(n / multiple)
 
 
+def _month(year, month) -> int:
+    return year * 100 + month
+
+
+def _content_hash(content, media_type, title, description) -> str:
+    """
+    Hash the editable content of a message. Only the text of polls and
+    webpages is included as the titles of files are set when they're
+    downloaded.
+    """
+    if media_type not in ("poll", "webpage"):
+        title, description = None, None
+    return hashlib.sha1(repr((content, title, description)).encode("utf8")).hexdigest()
+
+
 class DB:
     conn = None
 
-    def __init__(self, dbfile):
+    # Cache of user rows as last written to the DB, used to skip
+    # writing unchanged users in bulk inserts.
+    _users = None
+
+    # Cache of User() objects made from _users that are shared
+    # by all the messages read from the DB.
+    _user_objs = None
+
+    def __init__(self, dbfile, check_same_thread=True):
         # Initialize the SQLite DB. If it's new, create the table schema.
         is_new = not os.path.isfile(dbfile)
 
+        self.dbfile = dbfile
         self.conn = sqlite3.Connection(
-            dbfile, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            dbfile, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=check_same_thread)
 
         # Add the custom PAGE() function to get the page number of a row
         # by its row number and a limit multiple.
@@ -77,6 +273,17 @@ class DB:
                 self.conn.cursor().execute(s)
                 self.conn.commit()
 
+        self._migrate()
+
+    def _migrate(self):
+        """Apply pending schema migrations, each in its own transaction."""
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA user_version")
+        version, = cur.fetchone()
+
+        for n, m in enumerate(migrations[version:], version + 1):
+            cur.executescript("BEGIN; {}; PRAGMA user_version = {}; COMMIT;".format(m, n))
+
     def _parse_date(self, d) -> str:
         return datetime.strptime(d, "%Y-%m-%dT%H:%M:%S%z")
 
@@ -100,15 +307,15 @@ class DB:
         """
         cur = self.conn.cursor()
         cur.execute("""
-            SELECT strftime('%Y-%m-%d 00:00:00', date) as "[timestamp]",
-            COUNT(*) FROM messages AS count
-            GROUP BY strftime('%Y-%m', date) ORDER BY id
+            SELECT month, COUNT(*) FROM messages
+            GROUP BY month ORDER BY month
         """)
 
         for r in cur.fetchall():
-            yield Month(date=r[0],
-                        slug=r[0].strftime("%Y-%m"),
-                        label=r[0].strftime("%b %Y"),
+            date = datetime(r[0] // 100, r[0] % 100, 1)
+            yield Month(date=date,
+                        slug=date.strftime("%Y-%m"),
+                        label=date.strftime("%b %Y"),
                         count=r[1])
 
     def get_dayline(self, year, month, limit=500) -> Iterator[Day]:
@@ -121,11 +328,11 @@ class DB:
         cur.execute("""
             SELECT strftime("%Y-%m-%d 00:00:00", date) AS "[timestamp]",
             COUNT(*), PAGE(rank, ?) FROM (
-                SELECT ROW_NUMBER() OVER() as rank, date FROM messages
-                WHERE strftime('%Y%m', date) = ? ORDER BY id
+                SELECT ROW_NUMBER() OVER(ORDER BY id) as rank, date FROM messages
+                WHERE month = ?
             )
             GROUP BY "[timestamp]";
-        """, (limit, "{}{:02d}".format(year, month)))
+        """, (limit, _month(year, month)))
 
         for r in cur.fetchall():
             yield Day(date=r[0],
@@ -135,106 +342,528 @@ class DB:
                       page=r[2])
 
     def get_messages(self, year, month, last_id=0, limit=500) -> Iterator[Message]:
-        date = "{}{:02d}".format(year, month)
-
         cur = self.conn.cursor()
         cur.execute("""
-            SELECT messages.id, messages.type, messages.date, messages.edit_date,
-            messages.content, messages.reply_to, messages.user_id,
-            users.username, users.first_name, users.last_name, users.tags, users.avatar,
-            media.id, media.type, media.url, media.title, media.description, media.thumb
-            FROM messages
-            LEFT JOIN users ON (users.id = messages.user_id)
+            SELECT {} FROM messages
             LEFT JOIN media ON (media.id = messages.media_id)
-            WHERE strftime('%Y%m', date) = ?
+            WHERE messages.month = ?
             AND messages.id > ? ORDER by messages.id LIMIT ?
-            """, (date, last_id, limit))
+            """.format(_MESSAGE_COLS), (_month(year, month), last_id, limit))
 
-        for r in cur.fetchall():
+        for r in cur:
             yield self._make_message(r)
 
-    def get_message_count(self, year, month) -> int:
-        date = "{}{:02d}".format(year, month)
+    def get_last_messages(self, limit=100, per=None) -> Iterator[Message]:
+        """
+        Get the latest N messages in chronological order. If per is "month"
+        or "user", get the latest N messages of every month or user, grouped
+        by the month or user.
+        """
+        cur = self.conn.cursor()
+        if not per:
+            cur.execute("""
+                SELECT {} FROM (SELECT * FROM messages ORDER BY id DESC LIMIT ?) AS messages
+                    LEFT JOIN media ON (media.id = messages.media_id)
+                ORDER BY messages.id
+                """.format(_MESSAGE_COLS), (limit,))
+        else:
+            col = {"month": "month", "user": "user_id"}[per]
+            cur.execute("""
+                SELECT {cols} FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY {col} ORDER BY id DESC) AS n
+                    FROM messages
+                ) AS messages
+                    LEFT JOIN media ON (media.id = messages.media_id)
+                WHERE messages.n <= ?
+                ORDER BY messages.{col}, messages.id
+                """.format(cols=_MESSAGE_COLS, col=col), (limit,))
+
+        for r in cur:
+            yield self._make_message(r)
+
+    def search(self, query, limit=100) -> Iterator[Message]:
+        """
+        Get the messages matching an FTS5 query (eg: 'hello wor*') on the
+        message content and media titles and descriptions, best match first.
+        """
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT {} FROM messages_search
+            JOIN messages ON (messages.id = messages_search.rowid)
+            LEFT JOIN media ON (media.id = messages.media_id)
+            WHERE messages_search MATCH ? ORDER BY messages_search.rank LIMIT ?
+            """.format(_MESSAGE_COLS), (query, limit))
 
+        for r in cur:
+            yield self._make_message(r)
+
+    def get_search_terms(self) -> Iterator[tuple]:
+        """
+        Get every term in the search index and the IDs of the messages
+        that contain it as (term, [id, ...]) in the order of terms.
+        """
+        cur = self.conn.cursor()
+        cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS temp.messages_search_vocab
+            USING fts5vocab(main, messages_search, instance)""")
+
+        # Instances are in the order of terms and IDs, one per occurrence.
+        cur.execute("SELECT term, doc FROM temp.messages_search_vocab")
+        for term, rows in groupby(cur, key=lambda r: r[0]):
+            ids = []
+            for _, id in rows:
+                if not ids or ids[-1] != id:
+                    ids.append(id)
+            yield term, ids
+
+    def get_search_version(self) -> int:
+        """Get the version of the search index, which changes on every write to it."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT version FROM search_version")
+        return cur.fetchone()[0]
+
+    def get_page_ranges(self, per_page) -> Iterator[PageRange]:
+        """
+        Get the first and last message IDs of every page of every month
+        paginated by per_page messages.
+        """
         cur = self.conn.cursor()
         cur.execute("""
-            SELECT COUNT(*) FROM messages WHERE strftime('%Y%m', date) = ?
-            """, (date,))
+            SELECT month, PAGE(rank, ?) AS page, MIN(id), MAX(id) FROM (
+                SELECT month, id, ROW_NUMBER() OVER(PARTITION BY month ORDER BY id) AS rank
+                FROM messages
+            )
+            GROUP BY month, page ORDER BY month, page
+        """, (per_page,))
+
+        for r in cur:
+            date = datetime(r[0] // 100, r[0] % 100, 1)
+            yield PageRange(month=Month(date=date,
+                                        slug=date.strftime("%Y-%m"),
+                                        label=date.strftime("%b %Y"),
+                                        count=None),
+                            page=r[1], first_id=r[2], last_id=r[3])
+
+    def get_message_pages(self, per_page, ids=None) -> Iterator[MessagePage]:
+        """
+        Get the month and page number (paginated by per_page messages) of the
+        given message IDs, or if ids is None, of all the messages that are
+        replied to, in one pass over the messages.
+        """
+        cur = self.conn.cursor()
+        if ids is None:
+            where, args = "SELECT reply_to FROM messages WHERE reply_to IS NOT NULL", ()
+        else:
+            where, args = "SELECT value FROM JSON_EACH(?)", (json.dumps(list(ids)),)
+
+        cur.execute("""
+            SELECT id, month, PAGE(rank, ?) FROM (
+                SELECT id, month, ROW_NUMBER() OVER(PARTITION BY month ORDER BY id) AS rank
+                FROM messages
+            )
+            WHERE id IN ({})
+        """.format(where), (per_page, *args))
+
+        months = {}
+        for r in cur:
+            if r[1] not in months:
+                date = datetime(r[1] // 100, r[1] % 100, 1)
+                months[r[1]] = Month(date=date,
+                                     slug=date.strftime("%Y-%m"),
+                                     label=date.strftime("%b %Y"),
+                                     count=None)
+            yield MessagePage(id=r[0], month=months[r[1]], page=r[2])
+
+    def get_message_count(self, year, month) -> int:
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT COUNT(*) FROM messages WHERE month = ?
+            """, (_month(year, month),))
 
         total, = cur.fetchone()
         return total
 
     def insert_user(self, u: User):
         """Insert a user and if they exist, update the fields."""
+        row = self._user_row(u)
         cur = self.conn.cursor()
-        cur.execute("""INSERT INTO users (id, username, first_name, last_name, tags, avatar)
-            VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT (id)
-            DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
-                last_name=excluded.last_name, tags=excluded.tags, avatar=excluded.avatar
-            """, (u.id, u.username, u.first_name, u.last_name, " ".join(u.tags), u.avatar))
+        cur.execute(_INSERT_USER, row)
+        if self._users is not None:
+            self._update_users([row])
 
     def insert_media(self, m: Media):
         cur = self.conn.cursor()
-        cur.execute("""INSERT OR REPLACE INTO media
-            (id, type, url, title, description, thumb)
-            VALUES(?, ?, ?, ?, ?, ?)""",
-                    (m.id,
-                     m.type,
-                     m.url,
-                     m.title,
-                     m.description,
-                     m.thumb)
-                    )
+        cur.execute(_INSERT_MEDIA, self._media_row(m))
 
     def insert_message(self, m: Message):
         cur = self.conn.cursor()
-        cur.execute("""INSERT OR REPLACE INTO messages
-            (id, type, date, edit_date, content, reply_to, user_id, media_id)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (m.id,
-                     m.type,
-                     m.date.strftime("%Y-%m-%d %H:%M:%S"),
-                     m.edit_date.strftime(
-                         "%Y-%m-%d %H:%M:%S") if m.edit_date else None,
-                     m.content,
-                     m.reply_to,
-                     m.user.id,
-                     m.media.id if m.media else None)
-                    )
+        cur.execute(_INSERT_MESSAGE, self._message_row(m))
+        cur.execute(_INSERT_SEARCH, self._search_row(m))
+        cur.execute(_INSERT_DIRTY_MONTH, (_month(m.date.year, m.date.month),))
+        cur.execute(_UPDATE_SEARCH_VERSION)
+
+    def insert_messages(self, messages: list, downloads: list = ()):
+        """
+        Insert a batch of messages along with their users, media, and
+        pending downloads in a single transaction. Users are written once per
+        batch and skipped if they are unchanged since they were last written.
+        """
+        self._load_users()
+
+        users = {}
+        for m in messages:
+            u = self._user_row(m.user)
+            if self._users.get(u[0]) != u:
+                users[u[0]] = u
+
+        cur = self.conn.cursor()
+        try:
+            cur.executemany(_INSERT_USER, users.values())
+            cur.executemany(_INSERT_MEDIA, [self._media_row(m.media)
+                                            for m in messages if m.media])
+            cur.executemany(_INSERT_MESSAGE, [self._message_row(m) for m in messages])
+            cur.executemany(_INSERT_SEARCH, [self._search_row(m) for m in messages])
+            if messages:
+                cur.execute(_UPDATE_SEARCH_VERSION)
+            cur.executemany(_INSERT_DOWNLOAD, [(d.kind, d.id, d.message_id) for d in downloads])
+            cur.executemany(_INSERT_DIRTY_MONTH, {(_month(m.date.year, m.date.month),)
+                                                  for m in messages})
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+        self._update_users(users.values())
+
+    def get_downloads(self) -> Iterator[Download]:
+        """Get the pending downloads left over from previous syncs."""
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT kind, id, message_id, attempts FROM downloads ORDER BY message_id
+        """)
+
+        for r in cur.fetchall():
+            yield Download(*r)
+
+    def finish_media_download(self, id, url, title, thumb):
+        """Record a downloaded media file and remove its pending download."""
+        cur = self.conn.cursor()
+        cur.execute("UPDATE media SET url = ?, title = ?, thumb = ? WHERE id = ?",
+                    (url, title, thumb, id))
+        cur.execute("""UPDATE messages_search SET title = ?
+            WHERE rowid IN (SELECT id FROM messages WHERE media_id = ?)""", (title, id))
+        cur.execute(_UPDATE_SEARCH_VERSION)
+        cur.execute("DELETE FROM downloads WHERE kind = 'media' AND id = ?", (id,))
+        self.conn.commit()
+
+    def get_media_file(self, file_id) -> MediaFile:
+        """Get a file in the media store by its Telegram file ID, if it's there."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT file_id, file, title, thumb FROM media_files WHERE file_id = ?",
+                    (file_id,))
+        r = cur.fetchone()
+        return MediaFile(*r) if r else None
+
+    def insert_media_file(self, f: MediaFile):
+        cur = self.conn.cursor()
+        cur.execute(_INSERT_MEDIA_FILE, f)
+        self.conn.commit()
+
+    def get_pending_images(self) -> list:
+        """Get the downloaded media files that haven't been through the image pipeline."""
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT DISTINCT url FROM media
+            WHERE type = 'photo' AND url IS NOT NULL
+            AND url NOT IN (SELECT file FROM images)
+        """)
+        return [r[0] for r in cur.fetchall()]
+
+    def get_images(self) -> Iterator[Image]:
+        """Get the media images that have responsive sizes."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT file, width, height, sizes, thumb FROM images WHERE thumb IS NOT NULL")
+
+        for r in cur:
+            yield Image(file=r[0], width=r[1], height=r[2], sizes=json.loads(r[3]), thumb=r[4])
+
+    def insert_image(self, i: Image):
+        cur = self.conn.cursor()
+        cur.execute(_INSERT_IMAGE, (i.file, i.width, i.height, json.dumps(i.sizes), i.thumb))
+        self.conn.commit()
+
+    def set_image_thumbs(self) -> int:
+        """
+        Set the thumbnails made by the image pipeline on the media of their
+        files where they're not set yet, like new media of a file that was
+        already processed. Returns the number of media updated.
+        """
+        cur = self.conn.cursor()
+        cur.execute("""
+            UPDATE media SET thumb = (SELECT thumb FROM images WHERE file = media.url)
+            WHERE url IN (SELECT file FROM images WHERE thumb IS NOT NULL)
+            AND thumb IS NOT (SELECT thumb FROM images WHERE file = media.url)
+        """)
+        self.conn.commit()
+        return cur.rowcount
+
+    def finish_avatar_download(self, id, avatar, photo_id=None):
+        """
+        Record a downloaded user avatar and the Telegram photo ID it was
+        downloaded from, and remove its pending download.
+        """
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM downloads WHERE kind = 'avatar' AND id = ?", (id,))
+        self.set_avatar(Avatar(user_id=id, photo_id=photo_id, file=avatar))
+
+    def get_avatars(self) -> Iterator[Avatar]:
+        cur = self.conn.cursor()
+        cur.execute("SELECT user_id, photo_id, file FROM avatars")
+
+        for r in cur.fetchall():
+            yield Avatar(*r)
+
+    def set_avatar(self, a: Avatar):
+        """Record a user's avatar (or the lack of one) and set it on the user."""
+        cur = self.conn.cursor()
+        cur.execute(_INSERT_AVATAR, a)
+        cur.execute("UPDATE users SET avatar = ? WHERE id = ?", (a.file, a.user_id))
+        self.conn.commit()
+
+        if self._users is not None and a.user_id in self._users:
+            self._update_users([self._users[a.user_id][:5] + (a.file,)])
+
+    def fail_download(self, d: Download, attempts: int, error: str):
+        """Record failed attempts of a download, which is retried on the next sync."""
+        cur = self.conn.cursor()
+        cur.execute("""UPDATE downloads SET attempts = attempts + ?, error = ?
+            WHERE kind = ? AND id = ?""", (attempts, error, d.kind, d.id))
+        self.conn.commit()
+
+    def get_recent_message_ids(self, limit) -> list:
+        """Get the IDs of the latest N messages in order."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT id FROM messages ORDER BY id DESC LIMIT ?", (limit,))
+        return [r[0] for r in cur.fetchall()][::-1]
+
+    def get_changed_messages(self, messages: list) -> list:
+        """
+        Get the messages that aren't in the DB or whose edit date or
+        content hash differ from the ones in the DB.
+        """
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT messages.id, CAST(messages.edit_date AS TEXT), messages.hash, messages.content,
+                media.type, media.title, media.description
+            FROM messages LEFT JOIN media ON (media.id = messages.media_id)
+            WHERE messages.id IN (SELECT value FROM JSON_EACH(?))
+        """, (json.dumps([m.id for m in messages]),))
+
+        # Messages written before hashes were stored are hashed here.
+        existing = {r[0]: (r[1], r[2] or _content_hash(*r[3:])) for r in cur.fetchall()}
+
+        out = []
+        for m in messages:
+            row = self._message_row(m)
+            if existing.get(m.id) != (row[4], row[9]):
+                out.append(m)
+        return out
+
+    def delete_messages(self, ids: list):
+        """
+        Delete messages that no longer exist on Telegram. They're recorded
+        in deleted_messages and their months are marked as dirty.
+        """
+        cur = self.conn.cursor()
+        ids = json.dumps(ids)
+        try:
+            cur.execute("""INSERT OR REPLACE INTO deleted_messages (id, month, deleted_at)
+                SELECT id, month, datetime('now') FROM messages
+                WHERE id IN (SELECT value FROM JSON_EACH(?))""", (ids,))
+            cur.execute("""INSERT OR IGNORE INTO dirty_months (month)
+                SELECT month FROM messages WHERE id IN (SELECT value FROM JSON_EACH(?))""", (ids,))
+            cur.execute("DELETE FROM messages_search WHERE rowid IN (SELECT value FROM JSON_EACH(?))",
+                        (ids,))
+            cur.execute(_UPDATE_SEARCH_VERSION)
+            cur.execute("DELETE FROM messages WHERE id IN (SELECT value FROM JSON_EACH(?))", (ids,))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def get_dirty_months(self) -> Iterator[str]:
+        """Get the yyyy-mm slugs of the months with changes since the last build."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT month FROM dirty_months ORDER BY month")
+
+        for r in cur.fetchall():
+            yield "{}-{:02d}".format(r[0] // 100, r[0] % 100)
+
+    def clear_dirty_months(self):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM dirty_months")
+        self.conn.commit()
+
+    def delete_download(self, d: Download):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM downloads WHERE kind = ? AND id = ?", (d.kind, d.id))
+        self.conn.commit()
+
+    def get_sync_ranges(self) -> Iterator[SyncRange]:
+        """Get the message ID ranges of backfills in order."""
+        cur = self.conn.cursor()
+        cur.execute("""SELECT range_start, range_end, offset_id, done
+            FROM sync_state ORDER BY range_start""")
+
+        for r in cur.fetchall():
+            yield SyncRange(start=r[0], end=r[1], offset_id=r[2], done=bool(r[3]))
+
+    def insert_sync_ranges(self, ranges: list):
+        cur = self.conn.cursor()
+        cur.executemany("""INSERT OR REPLACE INTO sync_state
+            (range_start, range_end, offset_id, done) VALUES(?, ?, ?, ?)""", ranges)
+        self.conn.commit()
+
+    def set_sync_range_offset(self, start, offset_id, done=False):
+        """Save the checkpoint of a backfill range."""
+        cur = self.conn.cursor()
+        cur.execute("UPDATE sync_state SET offset_id = ?, done = ? WHERE range_start = ?",
+                    (offset_id, done, start))
+        self.conn.commit()
+
+    def set_ingest_pragmas(self):
+        """Tune the DB for bulk writes while syncing."""
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = NORMAL")
 
     def commit(self):
         """Commit pending writes to the DB."""
         self.conn.commit()
 
+    def writer(self) -> "DB":
+        """
+        Open another connection to the DB for writing message batches in a
+        thread while this one is being used, like the sync does to overlap
+        writes with fetches and downloads. It shares this instance's user
+        caches. The writer must only be used by one thread at a time and
+        should be closed with close().
+        """
+        w = DB(self.dbfile, check_same_thread=False)
+        w.set_ingest_pragmas()
+
+        self._load_users()
+        w._users, w._user_objs = self._users, self._user_objs
+        return w
+
+    def close(self):
+        self.conn.close()
+
+    def _user_row(self, u: User) -> tuple:
+        return (u.id, u.username, u.first_name, u.last_name, " ".join(u.tags), u.avatar)
+
+    def _media_row(self, m: Media) -> tuple:
+        return (m.id, m.type, m.url, m.title, m.description, m.thumb)
+
+    def _message_row(self, m: Message) -> tuple:
+        return (m.id,
+                m.type,
+                m.date.strftime("%Y-%m-%d %H:%M:%S"),
+                _month(m.date.year, m.date.month),
+                m.edit_date.strftime(
+                    "%Y-%m-%d %H:%M:%S") if m.edit_date else None,
+                m.content,
+                m.reply_to,
+                m.user.id,
+                m.media.id if m.media else None,
+                _content_hash(m.content, *((m.media.type, m.media.title, m.media.description)
+                                           if m.media else (None, None, None))))
+
+    def _search_row(self, m: Message) -> tuple:
+        title, desc = None, None
+        if m.media:
+            title, desc = m.media.title, m.media.description
+            if m.media.type == "poll":
+                desc = " ".join(o["label"] for o in json.loads(desc))
+
+        return (m.id, m.content, title, desc)
+
+    def _load_users(self):
+        if self._users is None:
+            cur = self.conn.cursor()
+            cur.execute("SELECT id, username, first_name, last_name, tags, avatar FROM users")
+            self._users = {r[0]: r for r in cur.fetchall()}
+            self._user_objs = {}
+
+    def _update_users(self, rows):
+        """Update the user caches with user rows written to the DB."""
+        for r in rows:
+            self._users[r[0]] = r
+            self._user_objs.pop(r[0], None)
+
+    def _get_user(self, id) -> User:
+        """Get a User() from the cache, shared by all messages from the user."""
+        u = self._user_objs.get(id)
+        if u is None:
+            r = self._users.get(id)
+            u = User(*r) if r else User(id, None, None, None, None, None)
+            self._user_objs[id] = u
+        return u
+
     def _make_message(self, m) -> Message:
         """Makes a Message() object from an SQL result tuple."""
-        id, typ, date, edit_date, content, reply_to, \
-            user_id, username, first_name, last_name, tags, avatar, \
+        id, typ, date, edit_date, content, reply_to, user_id, \
             media_id, media_type, media_url, media_title, media_description, media_thumb = m
 
         md = None
         if media_id:
             desc = media_description
             if media_type == "poll":
-                desc = json.loads(media_description)
-
-            md = Media(id=media_id,
-                       type=media_type,
-                       url=media_url,
-                       title=media_title,
-                       description=desc,
-                       thumb=media_thumb)
-
-        return Message(id=id,
-                       type=typ,
-                       date=date,
-                       edit_date=edit_date,
-                       content=content,
-                       reply_to=reply_to,
-                       user=User(id=user_id,
-                                 username=username,
-                                 first_name=first_name,
-                                 last_name=last_name,
-                                 tags=tags,
-                                 avatar=avatar),
-                       media=md)
+                desc = _LazyJSON(media_description)
+            md = Media(media_id, media_type, media_url, media_title, desc, media_thumb)
+
+        if self._user_objs is None:
+            self._load_users()
+
+        # fromisoformat() parses the same as sqlite3's timestamp converter.
+        return Message(id,
+                       typ,
+                       datetime.fromisoformat(date),
+                       datetime.fromisoformat(edit_date) if edit_date else None,
+                       content,
+                       reply_to,
+                       self._get_user(user_id),
+                       md)
+
+
+class _LazyJSON:
+    """
+    A JSON encoded list, like poll options, that's only decoded
+    when it's used in a template.
+    """
+    __slots__ = ("raw", "_value")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = None
+
+    def _get(self):
+        if self._value is None:
+            self._value = json.loads(self.raw)
+        return self._value
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __getitem__(self, i):
+        return self._get()[i]
+
+    def __eq__(self, other):
+        if isinstance(other, _LazyJSON):
+            return self.raw == other.raw
+        return self._get() == other
+
+    def __repr__(self):
+        return self.raw
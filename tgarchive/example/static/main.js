@@ -34,4 +34,218 @@
 			}
 		}, 100);
 	};
+
+	// Load the rest of the page's messages (lazy_pages) chunk by chunk as the
+	// page is scrolled to the end, and up to the message or day in the URL's
+	// #hash when it's not loaded yet.
+	const list = document.querySelector(".messages[data-chunks]");
+	if (list) {
+		const chunks = JSON.parse(list.dataset.chunks);
+		const loading = document.querySelector("#loading");
+		let next = 0, busy = null;
+
+		const loadNext = () => {
+			if (busy || next >= chunks.length) {
+				return busy;
+			}
+
+			busy = fetch(chunks[next].url).then((r) => {
+				if (!r.ok) {
+					throw new Error(`error fetching ${chunks[next].url}: ${r.status}`);
+				}
+				return r.json();
+			}).then((data) => {
+				list.insertAdjacentHTML("beforeend", data.html);
+				next++;
+			}).finally(() => {
+				busy = null;
+			});
+			return busy;
+		};
+
+		// Keep loading while the end of the list is near the viewport.
+		const loadVisible = async () => {
+			while (next < chunks.length && loading.getBoundingClientRect().top < window.innerHeight * 2) {
+				await loadNext();
+			}
+			if (next >= chunks.length) {
+				loading.remove();
+			}
+		};
+
+		const loadTo = async (hash) => {
+			const id = decodeURIComponent(hash.slice(1));
+			if (!id || document.getElementById(id)) {
+				return;
+			}
+
+			const n = chunks.findIndex((c) => c.days.includes(id) ||
+				(Number(id) >= c.first && Number(id) <= c.last));
+			if (n < 0) {
+				return;
+			}
+
+			while (next <= n) {
+				await loadNext();
+			}
+			document.getElementById(id).scrollIntoView();
+		};
+
+		new IntersectionObserver((e) => {
+			if (e[0].isIntersecting) {
+				loadVisible().catch((err) => console.log(err));
+			}
+		}, { rootMargin: "100%" }).observe(loading);
+
+		window.addEventListener("hashchange", () => loadTo(location.hash).catch((err) => console.log(err)));
+		loadTo(location.hash).catch((err) => console.log(err));
+	}
+
+	// Search the static search index. index.json lists the first term of every
+	// shard of the index and is loaded on the first search. Shards are loaded
+	// as they're needed for the search terms.
+	const search = document.querySelector("#search");
+	if (!search) {
+		return;
+	}
+
+	const results = document.querySelector("#search-results");
+	const maxResults = 50;
+	const cache = {};
+
+	const fetchJSON = (url) => {
+		if (!cache[url]) {
+			cache[url] = fetch(url).then((r) => {
+				if (!r.ok) {
+					throw new Error(`error fetching ${url}: ${r.status}`);
+				}
+				return r.json();
+			});
+		}
+		return cache[url];
+	};
+
+	// Split text into terms the way the index' unicode61 tokenizer does.
+	const tokenize = (s) => {
+		return s.normalize("NFD").replace(/\p{M}/gu, "").toLowerCase().
+			split(/[^\p{L}\p{N}]+/u).filter((t) => t);
+	};
+
+	// Get the IDs of messages with the term, or with terms starting with it.
+	const findTerm = async (index, term, prefix) => {
+		// The last shard starting at or before the term.
+		let lo = 0, hi = index.shards.length - 1;
+		while (lo < hi) {
+			const mid = Math.ceil((lo + hi) / 2);
+			if (index.shards[mid] <= term) {
+				lo = mid;
+			} else {
+				hi = mid - 1;
+			}
+		}
+
+		const ids = new Set();
+		for (let i = lo; i < index.shards.length; i++) {
+			if (i > lo && !(prefix && index.shards[i].startsWith(term))) {
+				break;
+			}
+
+			const shard = await fetchJSON(`search/${i}.json`);
+			for (const t in shard) {
+				if (t === term || (prefix && t.startsWith(term))) {
+					// IDs are delta encoded.
+					let id = 0;
+					shard[t].forEach((d) => {
+						id += d;
+						ids.add(id);
+					});
+				}
+			}
+		}
+		return ids;
+	};
+
+	// Get the page a message ID is on.
+	const findPage = (index, id) => {
+		let lo = 0, hi = index.pages.length - 1;
+		while (lo <= hi) {
+			const mid = Math.floor((lo + hi) / 2);
+			const [first, last, page] = index.pages[mid];
+			if (id < first) {
+				hi = mid - 1;
+			} else if (id > last) {
+				lo = mid + 1;
+			} else {
+				return page;
+			}
+		}
+		return null;
+	};
+
+	// Messages that have all the terms. The last term matches as a prefix
+	// unless the query ends with a space.
+	const runSearch = async (q) => {
+		const terms = tokenize(q);
+		if (terms.length === 0) {
+			return [];
+		}
+
+		const index = await fetchJSON("search/index.json");
+		let ids = null;
+		for (let i = 0; i < terms.length; i++) {
+			const prefix = i === terms.length - 1 && !/\s$/.test(q);
+			const found = await findTerm(index, terms[i], prefix);
+			ids = ids === null ? found : new Set([...ids].filter((id) => found.has(id)));
+			if (ids.size === 0) {
+				break;
+			}
+		}
+
+		// Latest messages first.
+		return [...ids].sort((a, b) => b - a).map((id) => ({ id, page: findPage(index, id) }));
+	};
+
+	let seq = 0;
+	search.onsubmit = async (e) => {
+		e.preventDefault();
+		const q = search.querySelector("input").value;
+		const n = ++seq;
+
+		let res = [];
+		try {
+			res = await runSearch(q);
+		} catch (err) {
+			console.log(err);
+		}
+
+		// A newer search has started.
+		if (n !== seq) {
+			return;
+		}
+
+		results.innerHTML = "";
+		if (res.length === 0) {
+			if (q.trim()) {
+				results.innerHTML = "<li class=\"empty\">No results.</li>";
+			}
+			return;
+		}
+
+		const head = document.createElement("li");
+		head.className = "count";
+		head.textContent = `${res.length} result(s)`;
+		results.appendChild(head);
+
+		res.slice(0, maxResults).forEach((r) => {
+			const li = document.createElement("li");
+			const a = document.createElement("a");
+			a.href = `${r.page}#${r.id}`;
+			a.textContent = `#${r.id} (${r.page.replace(".html", "")})`;
+			a.onclick = () => {
+				burger.checked = false;
+			};
+			li.appendChild(a);
+			results.appendChild(li);
+		});
+	};
 })();
@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+
+from PIL import Image as PILImage, ImageOps
+
+from .db import Image
+from .stats import Stats
+
+
+# Extensions of the image formats that get thumbnails and responsive sizes.
+_IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+
+# image_formats -> (file extension, PIL format).
+_FORMATS = {"webp": ("webp", "WEBP"), "jpeg": ("jpg", "JPEG")}
+
+_QUALITY = 80
+
+
+class Images:
+    """
+    Images is the image pipeline that makes thumbnails and responsive sizes
+    (image_sizes widths, in image_formats) of the downloaded media images,
+    locally with PIL in a pool of image_workers processes. The smallest size
+    becomes the media's thumbnail. It runs after a sync, or on its own, and
+    only processes files that haven't been processed yet, so an interrupted
+    run picks up where it stopped. Files that are already there aren't made
+    again. Media files that aren't images (like videos) are recorded as
+    processed without sizes.
+    """
+
+    def __init__(self, config, db, stats=None):
+        self.config = config
+        self.db = db
+        self.stats = stats or Stats()
+
+    def run(self) -> int:
+        """Process the pending media files and return the number processed."""
+        files = self.db.get_pending_images()
+        if files:
+            logging.info("making thumbnails and sizes of {} media files".format(len(files)))
+
+        n = 0
+        with self.stats.phase("images"):
+            if files:
+                args = [(os.path.join(self.config["media_dir"], f), self.config["image_sizes"],
+                         self.config["image_formats"]) for f in files]
+                with ProcessPoolExecutor(max(1, self.config["image_workers"])) as pool:
+                    for f, res in zip(files, pool.map(_make_images, args)):
+                        self.db.insert_image(self._make_image(f, res))
+                        n += 1
+                        self.stats.count("images processed")
+
+            # Media added for files that were already processed get their thumbnails.
+            self.db.set_image_thumbs()
+
+        if n:
+            logging.info("processed {} media files".format(n))
+        return n
+
+    def _make_image(self, f, res) -> Image:
+        width, height, sizes = res
+        if not sizes:
+            return Image(file=f, width=width, height=height, sizes=[], thumb=None)
+
+        fmt = "jpeg" if "jpeg" in self.config["image_formats"] else self.config["image_formats"][0]
+        return Image(file=f, width=width, height=height, sizes=sizes,
+                     thumb=image_file(f, sizes[0][0], fmt))
+
+
+def image_file(f, width, fmt) -> str:
+    """Get the name of the responsive size of a media file of the given width and format."""
+    return "{}-{}.{}".format(os.path.splitext(f)[0], width, _FORMATS[fmt][0])
+
+
+def _make_images(args):
+    """
+    Make the responsive sizes of an image file in a worker process and
+    return its width, height, and the [width, height] of every size. Sizes
+    are never larger than the image, and an image smaller than the largest
+    size gets a size of its own width. Files that can't be read as images
+    have no sizes.
+    """
+    fpath, widths, formats = args
+    if not fpath.lower().endswith(_IMAGE_EXTS):
+        return None, None, []
+
+    # Errors in a file, like images over Pillow's decompression bomb limit,
+    # are logged and the file is recorded without sizes so that it isn't
+    # retried on every run.
+    try:
+        return _resize(fpath, widths, formats)
+    except Exception as e:
+        logging.error("error processing image {}: {}".format(fpath, e))
+        return None, None, []
+
+
+def _resize(fpath, widths, formats):
+    im = PILImage.open(fpath)
+    im = ImageOps.exif_transpose(im)
+
+    w, h = im.size
+    sizes = [x for x in sorted(widths) if x < w]
+    if w <= max(widths):
+        sizes.append(w)
+
+    out = []
+    for x in sizes:
+        y = max(1, round(h * x / w))
+        resized = None
+        for fmt in formats:
+            target = image_file(fpath, x, fmt)
+            if os.path.exists(target):
+                continue
+
+            if resized is None:
+                resized = im.resize((x, y), PILImage.LANCZOS) if x != w else im
+            _save(resized, target, fmt)
+        out.append([x, y])
+
+    return w, h, out
+
+
+def _save(im, target, fmt):
+    """Save an image atomically in the format fmt."""
+    pil_fmt = _FORMATS[fmt][1]
+    if pil_fmt == "JPEG" or im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGB" if pil_fmt == "JPEG" else "RGBA")
+
+    tmp = target + ".tmp"
+    try:
+        im.save(tmp, pil_fmt, quality=_QUALITY)
+        os.replace(tmp, target)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
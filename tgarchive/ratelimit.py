@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+from telethon.errors import FloodWaitError
+
+
+class RateLimiter:
+    """
+    RateLimiter is an adaptive token bucket that spaces out Telegram API
+    requests. The interval between requests starts at wait seconds and
+    shrinks towards min_wait while responses are quick. It grows towards
+    max_wait when a response is slow compared to the moving average of
+    response times, or when Telegram responds with a FloodWait error, in
+    which case all requests are paused for the duration Telegram asks for.
+
+    clock and sleep can be swapped out to run against a simulated server.
+    """
+
+    def __init__(self, wait, min_wait, max_wait, burst=1,
+                 speedup=0.9, slowdown=2.0, slow_factor=2.0,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.min_wait = min_wait
+        self.max_wait = max(max_wait, min_wait)
+        self.interval = min(max(wait, self.min_wait), self.max_wait)
+        self.burst = burst
+        self.speedup = speedup
+        self.slowdown = slowdown
+        self.slow_factor = slow_factor
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = burst
+        self.updated = clock()
+        self.paused_until = 0
+
+        # Exponential moving average of response times.
+        self.avg_time = None
+
+        # Counters.
+        self.requests = 0
+        self.flood_waits = 0
+
+    async def acquire(self):
+        """Wait until a request can be made and take a token for it."""
+        while True:
+            now = self.clock()
+            if now < self.paused_until:
+                await self.sleep(self.paused_until - now)
+                continue
+
+            # Allow for float rounding in the refill.
+            self._refill(now)
+            if self.tokens >= 1 - 1e-9:
+                self.tokens -= 1
+                self.requests += 1
+                return
+
+            await self.sleep((1 - self.tokens) * self.interval)
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Make a request by awaiting fn(*args, **kwargs) within the rate limit
+        and adapt the rate to its response. FloodWait errors are retried
+        after the wait.
+        """
+        while True:
+            await self.acquire()
+            start = self.clock()
+            try:
+                res = await fn(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_wait(e.seconds)
+                continue
+
+            self.record(self.clock() - start)
+            return res
+
+    def record(self, took):
+        """Record the response time of a successful request and adapt the rate."""
+        if self.avg_time is not None and took > self.avg_time * self.slow_factor:
+            self._set_interval(self.interval * self.slowdown,
+                               "slow response ({:.1f}s, avg {:.1f}s)".format(took, self.avg_time))
+        else:
+            self._set_interval(self.interval * self.speedup, None)
+
+        self.avg_time = took if self.avg_time is None else self.avg_time * 0.8 + took * 0.2
+
+    def flood_wait(self, seconds):
+        """Pause all requests for seconds and slow down after a FloodWait error."""
+        self.flood_waits += 1
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+        self._set_interval(max(self.interval, 1) * self.slowdown,
+                           "FloodWait of {}s".format(seconds))
+
+    def _refill(self, now):
+        if self.interval > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    def _set_interval(self, interval, reason):
+        interval = min(max(interval, self.min_wait), self.max_wait)
+
+        # Log only when slowing down. Speeding up happens on every quick response.
+        if reason and interval > self.interval:
+            logging.info("rate limit: {}. waiting {:.1f}s between requests".format(
+                reason, interval))
+        self.interval = interval
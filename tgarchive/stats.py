@@ -0,0 +1,183 @@
+import cProfile
+import inspect
+import io
+import json
+import logging
+import os
+import pstats
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Stats:
+    """
+    Stats collects the wall and CPU time spent in the phases of a sync or
+    a build, counters (rows, pages, bytes written, downloads ...), and the
+    time spent in every DB query. Phases can be nested and entered many
+    times, and their times add up by name. Phases that run concurrently,
+    like media downloads in a sync, overlap and can add up to more than the
+    total time.
+
+    If profile is the name of a phase, the phase is run under cProfile.
+    """
+
+    def __init__(self, profile=None):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.queries = OrderedDict()
+
+        self.profile = profile
+        self.profiler = None
+        self._profiling = 0
+
+        # Names of the DB queries being run (nested), to which the
+        # SQL statements seen by the trace callback are attributed.
+        self._active = []
+
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the block as the named phase."""
+        p = self.phases.get(name)
+        if p is None:
+            p = self.phases[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0}
+
+        if name == self.profile:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            if self._profiling == 0:
+                self.profiler.enable()
+            self._profiling += 1
+
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            p["calls"] += 1
+            p["wall"] += time.perf_counter() - start
+            p["cpu"] += time.process_time() - cpu
+
+            if name == self.profile:
+                self._profiling -= 1
+                if self._profiling == 0:
+                    self.profiler.disable()
+
+    def count(self, name, n=1):
+        """Add n to the named counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def trace(self, db):
+        """
+        Time every query (public method) of the DB instance db and count
+        the SQL statements each one runs with the sqlite3 trace callback.
+        The time of a query that returns an iterator is the time spent getting
+        its rows, and not the time spent by the caller between rows.
+        """
+        db.conn.set_trace_callback(self._trace_sql)
+        for name, _ in inspect.getmembers(type(db), inspect.isfunction):
+            if not name.startswith("_"):
+                setattr(db, name, self._wrap_query(name, getattr(db, name)))
+
+    def report(self) -> dict:
+        """Return the stats as a JSON serializable dict."""
+        return {"wall": round(time.perf_counter() - self._start, 4),
+                "cpu": round(time.process_time() - self._cpu_start, 4),
+                "phases": {k: _round(v) for k, v in self.phases.items()},
+                "counters": dict(self.counters),
+                "queries": {k: _round(v) for k, v in self.queries.items()
+                            if v["calls"] or v["statements"]},
+                "profile": self.profile}
+
+    def summary(self) -> str:
+        """Return the stats as a table for printing."""
+        r = self.report()
+        out = ["{:34} {:>8} {:>10} {:>10}".format("phase", "calls", "wall (s)", "cpu (s)"),
+               "{:34} {:>8} {:>10.3f} {:>10.3f}".format("total", 1, r["wall"], r["cpu"])]
+        for k, v in r["phases"].items():
+            out.append("{:34} {:>8} {:>10.3f} {:>10.3f}".format(k, v["calls"], v["wall"], v["cpu"]))
+
+        if r["queries"]:
+            out.append("")
+            out.append("{:34} {:>8} {:>10} {:>10} {:>10}".format(
+                "query", "calls", "time (s)", "rows", "sql stmts"))
+            for k, v in sorted(r["queries"].items(), key=lambda q: -q[1]["time"]):
+                out.append("{:34} {:>8} {:>10.3f} {:>10} {:>10}".format(
+                    k if k.startswith("(") else "db." + k, v["calls"], v["time"], v["rows"], v["statements"]))
+
+        if r["counters"]:
+            out.append("")
+            out.append("{:34} {:>8}".format("counter", "value"))
+            for k, v in r["counters"].items():
+                out.append("{:34} {:>8}".format(k, v))
+
+        return "\n".join(out)
+
+    def save(self, path):
+        """
+        Write the report to the JSON file path and log the summary. The
+        cProfile output of the profiled phase, if any, is written next to
+        it with a .prof extension and its top functions are logged.
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+        logging.info("profile:\n{}".format(self.summary()))
+
+        if self.profiler:
+            pfile = os.path.splitext(path)[0] + ".prof"
+            self.profiler.dump_stats(pfile)
+
+            s = io.StringIO()
+            pstats.Stats(self.profiler, stream=s).sort_stats("cumulative").print_stats(25)
+            logging.info("cProfile of phase '{}' (saved to {}):\n{}".format(
+                self.profile, pfile, s.getvalue()))
+
+        logging.info("wrote profile report to {}".format(path))
+
+    def _wrap_query(self, name, method):
+        q = self.queries.setdefault(name, {"calls": 0, "time": 0.0, "rows": 0, "statements": 0})
+
+        def call(*args, **kwargs):
+            q["calls"] += 1
+            self._active.append(name)
+            start = time.perf_counter()
+            try:
+                res = method(*args, **kwargs)
+            finally:
+                q["time"] += time.perf_counter() - start
+                self._active.pop()
+
+            # Queries that return iterators run as their rows are consumed.
+            if hasattr(res, "__next__"):
+                return self._iter_query(name, q, res)
+            return res
+        return call
+
+    def _iter_query(self, name, q, it):
+        while True:
+            self._active.append(name)
+            start = time.perf_counter()
+            try:
+                row = next(it)
+            except StopIteration:
+                return
+            finally:
+                q["time"] += time.perf_counter() - start
+                self._active.pop()
+
+            q["rows"] += 1
+            yield row
+
+    def _trace_sql(self, sql):
+        name = self._active[-1] if self._active else "(other)"
+        q = self.queries.get(name)
+        if q is None:
+            q = self.queries[name] = {"calls": 0, "time": 0.0, "rows": 0, "statements": 0}
+        q["statements"] += 1
+
+
+def _round(d):
+    return {k: round(v, 4) if isinstance(v, float) else v for k, v in d.items()}
@@ -1,19 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from sys import exit
+import asyncio
+import hashlib
 import json
 import logging
 import os
 import re
-import tempfile
 import shutil
 import time
 
 from jinja2 import Template
 from PIL import Image
-from telethon.sync import TelegramClient
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 import telethon.tl.types
 
-from .db import User, Message, Media
+from .db import DB, User, Message, Media, Download, Avatar, MediaFile
+from .images import Images
+from .ratelimit import RateLimiter
+from .stats import Stats
+
+# Directory in the media directory where files are downloaded
+# before they're moved into the media store.
+_TMP_DIR = ".tmp"
 
 
 class Sync:
@@ -24,125 +34,372 @@ class Sync:
     config = {}
     db = None
 
-    def __init__(self, config, session_file, db):
+    # Load the account's dialogs (to sync the entity cache) before looking up
+    # the group. sync_groups() loads them once for all the groups.
+    load_dialogs = True
+
+    def __init__(self, config, session_file, db, client=None, stats=None, limiter=None):
+        """
+        client is an optional Telethon TelegramClient compatible object
+        to use instead of connecting to Telegram with the session file.
+        limiter is an optional RateLimiter shared with other Syncs.
+        """
         self.config = config
         self.db = db
+        self.stats = stats or Stats()
+
+        # Media and avatar downloads queued while parsing a batch of messages
+        # as (Download, Telegram message), and the users whose avatars have
+        # already been checked in this run.
+        self._downloads = []
+        self._avatar_ids = set()
+
+        # User ID -> Avatar() of the avatars on disk and the Telegram photo
+        # IDs they were downloaded from.
+        self._avatars = {a.user_id: a for a in self.db.get_avatars()}
+
+        # Telegram file ID -> Future of media files being downloaded into
+        # the media store, awaited by downloads of the same file.
+        self._media_files = {}
 
-        self.client = TelegramClient(
-            session_file, self.config["api_id"], self.config["api_hash"])
-        self.client.start()
+        # Adaptive rate limit on message batch fetches.
+        self._own_limiter = limiter is None
+        self._limiter = limiter or RateLimiter(self.config["fetch_wait"],
+                                               self.config["fetch_wait_min"],
+                                               self.config["fetch_wait_max"])
 
-        if not os.path.exists(self.config["media_dir"]):
-            os.mkdir(self.config["media_dir"])
+        self.client = client or new_client(self.config, session_file)
+        self.db.set_ingest_pragmas()
 
-    def sync(self, ids=None):
+        os.makedirs(self.config["media_dir"], exist_ok=True)
+
+    def sync(self, ids=None, backfill=False, reconcile=False):
         """
         Sync syncs messages from Telegram from the last synced message
-        into the local SQLite DB.
+        into the local SQLite DB. If backfill is set, the group's whole
+        history is fetched instead (see _backfill()), and if reconcile is
+        set, the latest messages are checked for edits and deletions
+        (see _reconcile()).
         """
+        try:
+            self.client.loop.run_until_complete(self.sync_async(ids, backfill, reconcile))
+        except GroupNotFoundError as e:
+            logging.critical(e)
+            # This is a critical error, so exit with code: 1
+            exit(1)
 
-        if ids:
-            last_id, last_date = (ids, None)
+        self.process_images()
+
+    def process_images(self):
+        """Run the image pipeline on the downloaded media, if it's enabled."""
+        if self.config["download_media"] and self.config["process_images"]:
+            Images(self.config, self.db, self.stats).run()
+
+    async def sync_async(self, ids=None, backfill=False, reconcile=False):
+        """
+        Async version of sync(). Message batches are fetched, parsed and
+        written while the next batch is being fetched and media files are
+        being downloaded in the background.
+        """
+        if backfill:
+            last_id, last_date = (0, None)
+            logging.info("backfilling all messages")
+        elif reconcile:
+            last_id, last_date = (0, None)
+        elif ids:
+            last_id, last_date = (0, None)
+            logging.info("fetching message id={}".format(ids))
         else:
             last_id, last_date = self.db.get_last_message_id()
+            if last_id:
+                logging.info("fetching from last message id={} ({})".format(
+                    last_id, last_date))
 
-        if ids:
-            logging.info("fetching message id={}".format(ids))
-        elif last_id:
-            logging.info("fetching from last message id={} ({})".format(
-                last_id, last_date))
+        group_id = await self._get_group_id(self.config["group"])
 
-        group_id = self._get_group_id(self.config["group"])
+        # Message batches are written in a thread with their own DB connection
+        # while the next batches are fetched and media is downloaded.
+        self._writer = self.db.writer()
+        self._write_pool = ThreadPoolExecutor(1)
 
-        n = 0
-        while True:
-            has = False
-            for m in self._get_messages(group_id,
-                    offset_id=last_id if last_id else 0,
-                    ids=ids):
-                if not m:
-                    continue
+        # Start the downloaders and finish downloads left over from an interrupted sync.
+        n = max(1, self.config["download_workers"])
+        q = asyncio.Queue(n * 2)
+        workers = [asyncio.ensure_future(self._download_worker(q)) for _ in range(n)]
 
-                has = True
+        try:
+            await self._resume_downloads(group_id, q)
+
+            n = 0
+            start = time.monotonic()
+            if backfill:
+                n = await self._backfill(group_id, q)
+            elif reconcile:
+                n = await self._reconcile(group_id, q)
+            else:
+                async for batch in self._iter_batches(group_id, last_id, ids):
+                    await self._write_batch(batch, q)
 
-                # Inser the records into DB.
-                self.db.insert_user(m.user)
+                    n += len(batch)
+                    last_date = batch[-1].date
+                    logging.info("fetched {} messages ({:.1f} messages/s)".format(
+                        n, n / max(time.monotonic() - start, 0.001)))
 
-                if m.media:
-                    self.db.insert_media(m.media)
+            if q.qsize():
+                logging.info("waiting for {} downloads".format(q.qsize()))
+            await q.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-                self.db.insert_message(m)
+            self._write_pool.shutdown()
+            self._writer.close()
 
-                last_date = m.date
-                n += 1
-                if n % 300 == 0:
-                    logging.info("fetched {} messages".format(n))
-                    self.db.commit()
+        self.stats.count("messages", n)
+        if self._own_limiter:
+            _count_requests(self.stats, self._limiter)
 
-                if self.config["fetch_limit"] > 0 and n >= self.config["fetch_limit"] or ids:
-                    has = False
-                    break
+        logging.info("finished {}. fetched {} messages. last message = {}".format(
+            self.config["group"], n, last_date))
 
-            self.db.commit()
-            if has:
-                last_id = m.id
-                logging.info("fetched {} messages. sleeping for {} seconds".format(
-                    n, self.config["fetch_wait"]))
-                time.sleep(self.config["fetch_wait"])
-            else:
-                break
+    async def _write_batch(self, batch, q):
+        """
+        Insert a batch of parsed messages into the DB in one go and queue
+        its downloads. This blocks if the downloaders are behind. It has to
+        be called right after the batch is parsed, before anything else can
+        queue downloads.
+        """
+        downloads, self._downloads = self._downloads, []
+        with self.stats.phase("sync: write"):
+            await asyncio.get_event_loop().run_in_executor(
+                self._write_pool, self._writer.insert_messages, batch, [d for d, _ in downloads])
+        self.stats.count("batches")
 
-        self.db.commit()
-        logging.info(
-            "finished. fetched {} messages. last message = {}".format(n, last_date))
+        with self.stats.phase("sync: wait for downloaders"):
+            for d in downloads:
+                await q.put(d)
 
-    def _get_messages(self, group, offset_id, ids=None) -> Message:
-        # https://docs.telethon.dev/en/latest/quick-references/objects-reference.html#message
-        for m in self.client.get_messages(group, offset_id=offset_id,
-                                          limit=self.config["fetch_batch_size"],
-                                          ids=ids,
-                                          reverse=True):
+    async def _write_changed(self, batch, q) -> list:
+        """
+        Write only the messages of a parsed batch that are new or have
+        changed, and queue only their downloads, so that messages already in
+        the DB keep their downloaded media. Returns the written messages.
+        """
+        changed = self.db.get_changed_messages(batch)
 
-            if not m or not m.sender:
-                continue
+        # Only the media of changed messages needs to be downloaded.
+        changed_ids = {m.id for m in changed}
+        self._downloads = [(d, m) for d, m in self._downloads
+                           if d.kind == "avatar" or d.message_id in changed_ids]
+        await self._write_batch(changed, q)
+        return changed
 
-            # Media.
-            sticker = None
-            med = None
-            if m.media:
-                # If it's a sticker, get the alt value (unicode emoji).
-                if isinstance(m.media, telethon.tl.types.MessageMediaDocument) and \
-                        hasattr(m.media, "document") and \
-                        m.media.document.mime_type == "application/x-tgsticker":
-                    alt = [a.alt for a in m.media.document.attributes if isinstance(
-                        a, telethon.tl.types.DocumentAttributeSticker)]
-                    if len(alt) > 0:
-                        sticker = alt[0]
-                elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
-                    med = self._make_poll(m)
-                else:
-                    med = self._get_media(m)
-
-            # Message.
-            typ = "message"
-            if m.action:
-                if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
-                    typ = "user_joined"
-                elif isinstance(m.action, telethon.tl.types.MessageActionChatDeleteUser):
-                    typ = "user_left"
-
-            yield Message(
-                type=typ,
-                id=m.id,
-                date=m.date,
-                edit_date=m.edit_date,
-                content=sticker if sticker else m.raw_text,
-                reply_to=m.reply_to_msg_id if m.reply_to and m.reply_to.reply_to_msg_id else None,
-                user=self._get_user(m.sender),
-                media=med
-            )
+    async def _backfill(self, group, q) -> int:
+        """
+        Fetch the group's whole history from the first message to the latest.
+        The message ID space is split into ranges of backfill_range_size IDs
+        that backfill_workers fetch concurrently within the rate limit. Every
+        range's checkpoint is saved in the DB after each batch so that an
+        interrupted backfill resumes where it stopped, and ranges are added
+        for messages newer than those of previous backfills. Messages in the
+        ranges are fetched again, which fills in gaps left by earlier partial
+        syncs, but only the ones that aren't in the DB or have changed are
+        written. fetch_limit doesn't apply.
+        Returns the number of messages fetched.
+        """
+        latest = await self._limiter.call(self.client.get_messages, group, limit=1)
+        if not latest:
+            return 0
+
+        # Add ranges up to the latest message.
+        ranges = list(self.db.get_sync_ranges())
+        size = max(1, self.config["backfill_range_size"])
+        last_id = latest[0].id
+        self.db.insert_sync_ranges([(s, min(s + size - 1, last_id), s - 1, False)
+                                    for s in range(ranges[-1].end + 1 if ranges else 1, last_id + 1, size)])
+
+        rq = asyncio.Queue()
+        for r in self.db.get_sync_ranges():
+            if not r.done:
+                rq.put_nowait(r)
+
+        n = max(1, self.config["backfill_workers"])
+        logging.info("backfilling {} ranges up to message id={} with {} workers".format(
+            rq.qsize(), last_id, n))
+
+        # Let the workers' requests run concurrently in the rate limit.
+        self._limiter.burst = n
+        workers = [asyncio.ensure_future(self._backfill_worker(group, rq, q)) for _ in range(n)]
+        try:
+            await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # If a worker failed (or the backfill was cancelled), stop the
+            # others before the downloaders they feed are stopped.
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        for w in workers:
+            if not w.cancelled() and w.exception():
+                raise w.exception()
+        return sum(w.result() for w in workers)
+
+    async def _backfill_worker(self, group, rq, q) -> int:
+        n = 0
+        while not rq.empty():
+            r = rq.get_nowait()
+            offset, start = r.offset_id, time.monotonic()
+            while offset < r.end:
+                msgs = [m for m in await self._fetch(group, offset) if m]
+                done = not msgs or msgs[-1].id >= r.end
+
+                # Messages past the range belong to the next one.
+                msgs = [m for m in msgs if m.id <= r.end]
+                with self.stats.phase("sync: parse"):
+                    batch = [m for m in map(self._parse_message, msgs) if m]
+                await self._write_changed(batch, q)
+
+                offset = r.end if done else msgs[-1].id
+                self.db.set_sync_range_offset(r.start, offset, done)
+                n += len(batch)
+
+            logging.info("backfilled message ids {}-{} in {:.1f}s".format(
+                r.start, r.end, time.monotonic() - start))
+        return n
+
+    async def _reconcile(self, group, q) -> int:
+        """
+        Re-fetch the latest reconcile_window messages in the DB by their IDs
+        and write only the ones whose edit date or content hash have changed.
+        Messages that Telegram no longer returns were deleted and are removed
+        from the DB. The months of the changes are marked as dirty for the
+        next build. Returns the number of changed messages.
+        """
+        ids = self.db.get_recent_message_ids(self.config["reconcile_window"])
+        if not ids:
+            return 0
+
+        logging.info("reconciling {} messages from id={}".format(len(ids), ids[0]))
+        n_changed, n_deleted = 0, 0
+
+        # 100 IDs is the most Telegram looks up in one request.
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            with self.stats.phase("sync: fetch"):
+                msgs = await self._limiter.call(self.client.get_messages, group, ids=chunk)
+
+            # Deleted messages come back empty.
+            found = {m.id for m in msgs if m}
+            deleted = [id for id in chunk if id not in found]
+
+            with self.stats.phase("sync: parse"):
+                batch = [m for m in map(self._parse_message, [m for m in msgs if m]) if m]
+            changed = await self._write_changed(batch, q)
+
+            if deleted:
+                self.db.delete_messages(deleted)
+
+            n_changed += len(changed)
+            n_deleted += len(deleted)
+
+        logging.info("reconciled {} messages. {} changed, {} deleted".format(
+            len(ids), n_changed, n_deleted))
+        return n_changed
+
+    async def _iter_batches(self, group, offset_id=0, ids=None):
+        """
+        Iterate over batches of parsed messages after offset_id (or the
+        given message ids) up to fetch_limit messages. The next batch is
+        fetched from Telegram while the current one is being processed.
+        """
+        limit = self.config["fetch_limit"]
+        fetch = asyncio.ensure_future(self._fetch(group, offset_id, ids))
+        n = 0
+
+        try:
+            while fetch:
+                msgs = [m for m in await fetch if m]
+                fetch = None
+                if not msgs:
+                    break
+
+                # Prefetch the next batch. Yield to the loop so that its request
+                # is sent before the batch is parsed and written.
+                if not ids and (limit <= 0 or n + len(msgs) < limit):
+                    fetch = asyncio.ensure_future(self._fetch(group, msgs[-1].id))
+                    await asyncio.sleep(0)
+
+                batch = []
+                with self.stats.phase("sync: parse"):
+                    for m in msgs:
+                        m = self._parse_message(m)
+                        if not m:
+                            continue
+
+                        batch.append(m)
+                        n += 1
+                        if limit > 0 and n >= limit:
+                            break
+
+                if batch:
+                    yield batch
+        finally:
+            if fetch:
+                fetch.cancel()
+
+    async def _fetch(self, group, offset_id, ids=None) -> list:
+        """Fetch one batch of raw Telegram messages within the rate limit."""
+        # https://docs.telethon.dev/en/latest/quick-references/objects-reference.html#message
+        with self.stats.phase("sync: fetch"):
+            return await self._limiter.call(self.client.get_messages, group,
+                                            offset_id=offset_id,
+                                            limit=self.config["fetch_batch_size"],
+                                            ids=ids,
+                                            reverse=True)
+
+    def _parse_message(self, m) -> Message:
+        """Make a Message() from a Telegram message and queue its downloads."""
+        if not m.sender:
+            return None
+
+        # Media.
+        sticker = None
+        med = None
+        if m.media:
+            # If it's a sticker, get the alt value (unicode emoji).
+            if isinstance(m.media, telethon.tl.types.MessageMediaDocument) and \
+                    hasattr(m.media, "document") and \
+                    m.media.document.mime_type == "application/x-tgsticker":
+                alt = [a.alt for a in m.media.document.attributes if isinstance(
+                    a, telethon.tl.types.DocumentAttributeSticker)]
+                if len(alt) > 0:
+                    sticker = alt[0]
+            elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
+                med = self._make_poll(m)
+            else:
+                med = self._get_media(m)
+
+        # Message.
+        typ = "message"
+        if m.action:
+            if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
+                typ = "user_joined"
+            elif isinstance(m.action, telethon.tl.types.MessageActionChatDeleteUser):
+                typ = "user_left"
+
+        return Message(
+            type=typ,
+            id=m.id,
+            date=m.date,
+            edit_date=m.edit_date,
+            content=sticker if sticker else m.raw_text,
+            reply_to=m.reply_to_msg_id if m.reply_to and m.reply_to.reply_to_msg_id else None,
+            user=self._get_user(m.sender, m),
+            media=med
+        )
 
-    def _get_user(self, u) -> User:
+    def _get_user(self, u, msg) -> User:
         tags = []
         is_normal_user = isinstance(u, telethon.tl.types.User)
 
@@ -156,15 +413,9 @@ class Sync:
         if u.fake:
             tags.append("fake")
 
-        # Download sender's profile photo if it's not already cached.
         avatar = None
         if self.config["download_avatars"]:
-            try:
-                fname = self._download_avatar(u)
-                avatar = fname
-            except Exception as e:
-                logging.error(
-                    "error downloading avatar: #{}: {}".format(u.id, e))
+            avatar = self._get_avatar(u, msg)
 
         return User(
             id=u.id,
@@ -175,6 +426,42 @@ class Sync:
             avatar=avatar
         )
 
+    def _get_avatar(self, u, msg) -> str:
+        """
+        Get the filename of a user's avatar. The first time a user is seen in
+        a run, their profile photo is queued for downloading if its Telegram
+        photo ID has changed since the avatar was downloaded.
+        """
+        if u.id not in self._avatar_ids:
+            self._avatar_ids.add(u.id)
+
+            a = self._avatars.get(u.id)
+            photo_id = self._get_photo_id(u)
+            fname = "avatar_{}.jpg".format(u.id)
+
+            if a and a.photo_id == photo_id:
+                pass
+            elif photo_id is None:
+                # The user has no profile photo (anymore).
+                self._set_avatar(Avatar(user_id=u.id, photo_id=None, file=None))
+            elif not a and os.path.exists(os.path.join(self.config["media_dir"], fname)):
+                # Avatars downloaded before photo IDs were recorded are kept.
+                self._set_avatar(Avatar(user_id=u.id, photo_id=photo_id, file=fname))
+            else:
+                # Until the download finishes, the previous avatar, if any, is used.
+                self._downloads.append(
+                    (Download(kind="avatar", id=u.id, message_id=msg.id, attempts=0), msg))
+
+        a = self._avatars.get(u.id)
+        return a.file if a else None
+
+    def _get_photo_id(self, u) -> int:
+        return getattr(u.photo, "photo_id", None)
+
+    def _set_avatar(self, a: Avatar):
+        self.db.set_avatar(a)
+        self._avatars[a.user_id] = a
+
     def _make_poll(self, msg):
         options = [{"label": a.text, "count": 0, "correct": False}
                    for a in msg.media.poll.answers]
@@ -210,45 +497,184 @@ class Sync:
                 isinstance(msg.media, telethon.tl.types.MessageMediaDocument) or \
                 isinstance(msg.media, telethon.tl.types.MessageMediaContact):
             if self.config["download_media"]:
-                logging.info("downloading media #{}".format(msg.id))
-                try:
-                    basename, fname, thumb = self._download_media(msg)
-                    return Media(
-                        id=msg.id,
-                        type="photo",
-                        url=fname,
-                        title=basename,
-                        description=None,
-                        thumb=thumb
-                    )
-                except Exception as e:
-                    logging.error(
-                        "error downloading media: #{}: {}".format(msg.id, e))
-
-    def _download_media(self, msg) -> [str, str, str]:
+                # The file is downloaded in the background and the media
+                # record is updated once it's done.
+                self._downloads.append(
+                    (Download(kind="media", id=msg.id, message_id=msg.id, attempts=0), msg))
+                return Media(
+                    id=msg.id,
+                    type="photo",
+                    url=None,
+                    title=None,
+                    description=None,
+                    thumb=None
+                )
+
+    async def _resume_downloads(self, group, q):
+        """Re-fetch the messages of pending downloads from previous syncs and queue them."""
+        pending = list(self.db.get_downloads())
+        if not pending:
+            return
+
+        logging.info("resuming {} pending downloads".format(len(pending)))
+        msgs = {}
+        for i in range(0, len(pending), 100):
+            ids = [d.message_id for d in pending[i:i + 100]]
+            with self.stats.phase("sync: fetch"):
+                found = await self._limiter.call(self.client.get_messages, group, ids=ids)
+            for m in found:
+                if m:
+                    msgs[m.id] = m
+
+        for d in pending:
+            # The message no longer exists.
+            if d.message_id not in msgs:
+                self.db.delete_download(d)
+                continue
+
+            if d.kind == "avatar":
+                self._avatar_ids.add(d.id)
+            await q.put((d, msgs[d.message_id]))
+
+    async def _download_worker(self, q):
+        while True:
+            d, msg = await q.get()
+            try:
+                await self._download_job(d, msg)
+            except Exception as e:
+                logging.error("error downloading {} #{}: {}".format(d.kind, d.id, e))
+            finally:
+                q.task_done()
+
+    async def _download_job(self, d, msg):
+        """
+        Download a media file or avatar with retries. If all attempts fail,
+        the download is left pending to be retried on the next sync.
+        """
+        retries = max(1, self.config["download_retries"])
+        for n in range(1, retries + 1):
+            try:
+                with self.stats.phase("sync: download " + d.kind):
+                    if d.kind == "media":
+                        logging.info("downloading media #{}".format(msg.id))
+                        basename, fname, thumb = await self._download_media(msg)
+                        self.db.finish_media_download(d.id, fname, basename, thumb)
+                    else:
+                        photo_id = self._get_photo_id(msg.sender)
+                        fname = await self._download_avatar(msg.sender)
+                        self.db.finish_avatar_download(d.id, fname, photo_id)
+                        self._avatars[d.id] = Avatar(user_id=d.id, photo_id=photo_id, file=fname)
+                self.stats.count("{} downloads".format(d.kind))
+                return
+            except Exception as e:
+                logging.error("error downloading {} #{} (attempt {}/{}): {}".format(
+                    d.kind, d.id, n, retries, e))
+                if n == retries:
+                    self.stats.count("failed downloads")
+                    self.db.fail_download(d, retries, str(e))
+                    return
+
+                self.stats.count("download retries")
+                if isinstance(e, FloodWaitError):
+                    # Slow down message fetching as well.
+                    self._limiter.flood_wait(e.seconds)
+                    await asyncio.sleep(e.seconds)
+                else:
+                    await asyncio.sleep(2 ** n)
+
+    async def _download_media(self, msg) -> [str, str, str]:
         """
-        Download a media / file attached to a message and return its original
-        filename, sanitized name on disk, and the thumbnail (if any). 
+        Download a media / file attached to a message into the media store
+        and return its original filename, path in the media directory, and the
+        thumbnail's (if any). Files that are already in the store by their
+        Telegram photo or document ID, like forwards, aren't downloaded again.
         """
-        # Download the media to the temp dir and copy it back as
-        # there does not seem to be a way to get the canonical
-        # filename before the download.
-        fpath = self.client.download_media(msg, file=tempfile.gettempdir())
-        basename = os.path.basename(fpath)
-
-        newname = "{}.{}".format(msg.id, self._get_file_ext(basename))
-        shutil.move(fpath, os.path.join(self.config["media_dir"], newname))
-
-        # If it's a photo, download the thumbnail.
-        tname = None
-        if isinstance(msg.media, telethon.tl.types.MessageMediaPhoto):
-            tpath = self.client.download_media(
-                msg, file=tempfile.gettempdir(), thumb=1)
-            tname = "thumb_{}.{}".format(
-                msg.id, self._get_file_ext(os.path.basename(tpath)))
-            shutil.move(tpath, os.path.join(self.config["media_dir"], tname))
-
-        return basename, newname, tname
+        file_id = self._get_file_id(msg.media)
+        if file_id is None:
+            return await self._fetch_media(msg)
+
+        while True:
+            # The same file is being downloaded for another message.
+            if file_id in self._media_files:
+                f = await asyncio.shield(self._media_files[file_id])
+                if f:
+                    return f.title, f.file, f.thumb
+                continue
+
+            f = self.db.get_media_file(file_id)
+            if f and os.path.exists(os.path.join(self.config["media_dir"], f.file)):
+                logging.info("media #{} is already in the store".format(msg.id))
+                return f.title, f.file, f.thumb
+            break
+
+        fut = asyncio.get_event_loop().create_future()
+        self._media_files[file_id] = fut
+        f = None
+        try:
+            title, fname, thumb = await self._fetch_media(msg)
+            f = MediaFile(file_id=file_id, file=fname, title=title, thumb=thumb)
+            self.db.insert_media_file(f)
+            return f.title, f.file, f.thumb
+        finally:
+            # Waiting downloads of the file start over if this one failed.
+            fut.set_result(f)
+            del self._media_files[file_id]
+
+    async def _fetch_media(self, msg) -> [str, str, str]:
+        """
+        Download a message's media into the media store and return the values
+        for _download_media(). Files are downloaded to a temporary directory
+        inside the media directory as there does not seem to be a way to get
+        the canonical filename before the download, and then moved into place.
+        """
+        tmpdir = os.path.join(self.config["media_dir"], _TMP_DIR, str(msg.id))
+        os.makedirs(tmpdir, exist_ok=True)
+        try:
+            fpath = await self.client.download_media(msg, file=tmpdir)
+            basename = os.path.basename(fpath)
+            fname = self._store_file(fpath, self._get_file_ext(basename))
+
+            # If it's a photo, download the thumbnail, unless the image
+            # pipeline makes it from the file.
+            tname = None
+            if isinstance(msg.media, telethon.tl.types.MessageMediaPhoto) and \
+                    not self.config["process_images"]:
+                tpath = await self.client.download_media(msg, file=tmpdir, thumb=1)
+                tname = self._store_file(tpath, self._get_file_ext(os.path.basename(tpath)))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return basename, fname, tname
+
+    def _store_file(self, fpath, ext) -> str:
+        """
+        Move a file into the media store, named by the hash of its contents,
+        and return its path in the media directory. If the store already has
+        the file, the new copy is discarded.
+        """
+        h = hashlib.sha256()
+        with open(fpath, "rb") as f:
+            for b in iter(lambda: f.read(1 << 20), b""):
+                h.update(b)
+        digest = h.hexdigest()
+        self.stats.count("bytes downloaded", os.path.getsize(fpath))
+
+        name = "{}/{}.{}".format(digest[:2], digest, ext)
+        target = os.path.join(self.config["media_dir"], name)
+        if os.path.exists(target):
+            os.remove(fpath)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(fpath, target)
+        return name
+
+    def _get_file_id(self, media) -> int:
+        """Get the Telegram ID of the photo or document of a message's media, if any."""
+        if isinstance(media, telethon.tl.types.MessageMediaPhoto) and media.photo:
+            return media.photo.id
+        if isinstance(media, telethon.tl.types.MessageMediaDocument) and media.document:
+            return media.document.id
+        return None
 
     def _get_file_ext(self, f) -> str:
         if "." in f:
@@ -258,26 +684,29 @@ class Sync:
 
         return ".file"
 
-    def _download_avatar(self, user):
+    async def _download_avatar(self, user):
         fname = "avatar_{}.jpg".format(user.id)
         fpath = os.path.join(self.config["media_dir"], fname)
 
-        if os.path.exists(fpath):
-            return fname
-
         logging.info("downloading avatar #{}".format(user.id))
 
         # Download the file into a container, resize it, and then write to disk.
+        # Telegram's small (160x160) profile photo is enough for most avatar sizes.
+        # Users without a profile photo have no avatar.
         b = BytesIO()
-        self.client.download_profile_photo(user, file=b)
+        big = max(self.config["avatar_size"]) > 160
+        if not await self.client.download_profile_photo(user, file=b, download_big=big):
+            return None
+        self.stats.count("bytes downloaded", b.getbuffer().nbytes)
 
-        im = Image.open(b)
-        im.thumbnail(self.config["avatar_size"], Image.ANTIALIAS)
-        im.save(fpath, "JPEG")
+        # Resize in a thread so that the image processing doesn't block
+        # the event loop that fetches and writes messages.
+        await asyncio.get_event_loop().run_in_executor(
+            None, _resize_avatar, b, self.config["avatar_size"], fpath)
 
         return fname
 
-    def _get_group_id(self, group):
+    async def _get_group_id(self, group):
         """
         Syncs the Entity cache and returns the Entity ID for the specified group,
         which can be a str/int for group ID, group name, or a group username.
@@ -287,7 +716,8 @@ class Sync:
         # Get all dialogs for the authorized user, which also
         # syncs the entity cache to get latest entities
         # ref: https://docs.telethon.dev/en/latest/concepts/entities.html#getting-entities
-        _ = self.client.get_dialogs()
+        if self.load_dialogs:
+            _ = await self.client.get_dialogs()
 
         try:
             # If the passed group is a group ID, extract it.
@@ -298,11 +728,74 @@ class Sync:
             pass
 
         try:
-            entity = self.client.get_entity(group)
+            entity = await self.client.get_entity(group)
         except ValueError:
-            logging.critical("the group: {} does not exist,"
-                          " or the authorized user is not a participant!".format(group))
-            # This is a critical error, so exit with code: 1
-            exit(1)
+            raise GroupNotFoundError("the group: {} does not exist,"
+                                     " or the authorized user is not a participant!".format(group))
 
         return entity.id
+
+
+class GroupNotFoundError(ValueError):
+    """Raised when the group to sync doesn't exist or the user isn't in it."""
+
+
+def new_client(config, session_file):
+    """Start a Telegram client with the config's API credentials and the session file."""
+    client = TelegramClient(session_file, config["api_id"], config["api_hash"])
+    client.start()
+    return client
+
+
+def sync_groups(configs, session_file, ids=None, backfill=False, reconcile=False,
+                stats=None, client=None):
+    """
+    Sync several groups, with a config each (see get_group_configs()),
+    concurrently with one Telegram client and session. The account's dialogs
+    are loaded once for all the groups, and message fetches of all the groups
+    share one rate limit, that of the first config. Every group has its own
+    DB (the config's data). Errors in a group are logged and don't stop the
+    others.
+    """
+    base = configs[0]
+    client = client or new_client(base, session_file)
+    limiter = RateLimiter(base["fetch_wait"], base["fetch_wait_min"], base["fetch_wait_max"])
+
+    syncs = []
+    for c in configs:
+        if os.path.dirname(c["data"]):
+            os.makedirs(os.path.dirname(c["data"]), exist_ok=True)
+
+        db = DB(c["data"])
+        if stats:
+            stats.trace(db)
+
+        s = Sync(c, session_file, db, client=client, stats=stats, limiter=limiter)
+        s.load_dialogs = False
+        syncs.append(s)
+
+    async def run():
+        await client.get_dialogs()
+        res = await asyncio.gather(*[s.sync_async(ids, backfill, reconcile) for s in syncs],
+                                   return_exceptions=True)
+        for c, r in zip(configs, res):
+            if isinstance(r, Exception):
+                logging.error("error syncing group {}: {}".format(c["group"], r))
+
+    client.loop.run_until_complete(run())
+    if stats:
+        _count_requests(stats, limiter)
+
+    for s in syncs:
+        s.process_images()
+
+
+def _count_requests(stats, limiter):
+    stats.count("requests", limiter.requests)
+    stats.count("flood waits", limiter.flood_waits)
+
+
+def _resize_avatar(b, size, fpath):
+    im = Image.open(b)
+    im.thumbnail(size, Image.LANCZOS)
+    im.convert("RGB").save(fpath, "JPEG")